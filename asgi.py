@@ -0,0 +1,256 @@
+# Асинхронный (ASGI) вариант клиентских эндпоинтов: /check_key, /check_keys,
+# /apply_promo, /check_update, /promo/redeem, /lease/*.
+# Ответы байт-в-байт как у Flask-версии в server.py, админка остаётся на Flask.
+#
+#   uvicorn asgi:app --workers 2
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+import os
+import json
+import time
+import contextlib
+import contextvars
+from datetime import datetime
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.exceptions import BadRequest, HTTPException, UnsupportedMediaType
+
+import server
+
+# Один процесс держит тысячи запросов в ожидании, поэтому пул по умолчанию больше, чем у Flask-воркера
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv("ASYNC_DB_POOL_MIN_SIZE", "2"))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX_SIZE", "20"))
+
+pool = AsyncConnectionPool(
+    server.DATABASE_URL,
+    min_size=ASYNC_DB_POOL_MIN_SIZE,
+    max_size=ASYNC_DB_POOL_MAX_SIZE,
+    timeout=server.DB_POOL_TIMEOUT,
+    max_idle=server.DB_POOL_MAX_IDLE,
+    max_lifetime=server.DB_POOL_MAX_LIFETIME,
+    check=AsyncConnectionPool.check_connection if server.DB_POOL_CHECK else None,
+    kwargs={"row_factory": dict_row, "cursor_factory": server.AsyncTimedCursor},
+    name="crossfocusx-async",
+    open=False,
+)
+
+# маршрут текущего запроса (для метрик исходов в json_response)
+_route = contextvars.ContextVar("route", default="unmatched")
+OUTCOME_ROUTES = {"/check_key", "/check_keys", "/apply_promo", "/lease/renew"}
+
+@contextlib.asynccontextmanager
+async def get_conn():
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        server.record_acquire(time.perf_counter() - started)
+        yield conn
+
+def json_response(payload, status=200, headers=None):
+    # тот же JSON-провайдер, что у Flask: сортировка ключей, компактный вывод, \n в конце
+    if _route.get() in OUTCOME_ROUTES:
+        server.record_outcome(_route.get(), payload)
+    body = server.app.json.dumps(payload, separators=(",", ":")) + "\n"
+    return Response(body, status_code=status, headers=headers, media_type="application/json")
+
+def rate_limited(request, hwid="", cost=1):
+    ip = server.client_ip(request.client.host if request.client else "", request.headers)
+    return server.throttled(ip, hwid, cost)
+
+async def read_json(request):
+    # как request.json во Flask: 415, если Content-Type не JSON, 400 на битое тело
+    mimetype = request.headers.get("content-type", "").partition(";")[0].strip().lower()
+    if mimetype != "application/json" and not (mimetype.startswith("application/") and mimetype.endswith("+json")):
+        raise UnsupportedMediaType(
+            "Did not attempt to load JSON data because the request Content-Type was not 'application/json'."
+        )
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        raise BadRequest()
+
+async def http_error(request, exc):
+    # та же HTML-страница ошибки werkzeug, что отдаёт Flask
+    return Response(exc.get_body(), status_code=exc.code, headers=dict(exc.get_headers()))
+
+async def check_key(request):
+    data = await read_json(request) or {}
+    key = (data.get("key") or "").strip().upper()
+    hwid = (data.get("hwid") or "").strip()
+
+    if not key or not hwid:
+        return json_response({"status": "invalid", "reason": "missing_data"})
+    if rate_limited(request, hwid):
+        return json_response(server.RATE_LIMITED_RESPONSE, 429, {"Retry-After": "1"})
+
+    now = datetime.now()
+    row = server.key_cache.get(key)
+    if row is None or not row["active"] or row["expires_at"] <= now:
+        if not server.key_filter.check(key):
+            return json_response({"status": "invalid", "reason": "not_found"})
+        async with get_conn() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(server.KEY_LOOKUP_SQL, (key,))
+                row = await cur.fetchone()
+        if not row:
+            return json_response({"status": "invalid", "reason": "not_found"})
+        if server.cacheable_key(row, now):
+            server.key_cache.set(key, row)
+
+    result = server.key_check_result(key, row, hwid, now)
+    if result["status"] == "ok" and not row["hwid"]:
+        # очередь отложенной записи общая с Flask-кодом и синхронная — ждём её в пуле потоков
+        saved = (await run_in_threadpool(server.key_writer.bind, {key: hwid}))[key]
+        if saved is None:
+            return json_response({"status": "invalid", "reason": "not_found"})
+        result = server.key_check_result(key, dict(row, hwid=saved), hwid, now)
+    if result["status"] == "ok":
+        server.key_writer.touch(key, server.client_version(data), now)
+
+    return json_response(server.with_lease(result, data, now))
+
+async def check_keys(request):
+    data = await read_json(request) or {}
+    pairs = server.parse_key_pairs(data)
+    if pairs is None:
+        return json_response({"status": "invalid", "reason": "missing_data"}, 400)
+    if len(pairs) > server.CHECK_KEYS_MAX:
+        return json_response(
+            {"status": "invalid", "reason": "too_many_keys", "max": server.CHECK_KEYS_MAX}, 400
+        )
+    if rate_limited(request, cost=len(pairs)):
+        return json_response(server.RATE_LIMITED_RESPONSE, 429, {"Retry-After": "1"})
+
+    now = datetime.now()
+    rows, missing = server.cached_key_rows(pairs, now)
+    missing = [key for key in missing if server.key_filter.check(key)]
+    if missing:
+        async with get_conn() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(server.KEYS_LOOKUP_SQL, (missing,))
+                for row in await cur.fetchall():
+                    rows[row["key"]] = row
+                    if server.cacheable_key(row, now):
+                        server.key_cache.set(row["key"], row)
+
+    binds = server.pending_binds(pairs, rows, now)
+    if binds:
+        for key, saved_hwid in (await run_in_threadpool(server.key_writer.bind, binds)).items():
+            server.apply_bind(rows, key, saved_hwid)
+
+    results = server.batch_results(pairs, rows, now)
+    version = server.client_version(data) if isinstance(data, dict) else ""
+    for result in results:
+        if result["status"] == "ok":
+            server.key_writer.touch(result["key"], version, now)
+    return json_response({"status": "ok", "results": results})
+
+async def apply_promo(request):
+    data = await read_json(request) or {}
+    code = (data.get("code") or "").strip().upper()
+    key = (data.get("key") or "").strip().upper()
+    hwid = (data.get("hwid") or "").strip()
+    if not code or not key or not hwid:
+        return json_response({"status": "invalid", "reason": "missing_data"}, 400)
+    if rate_limited(request, hwid):
+        return json_response(server.RATE_LIMITED_RESPONSE, 429, {"Retry-After": "1"})
+    if not server.key_filter.check(key):
+        return json_response(*server.promo_result(code, {"reason": "key_not_found"}))
+    reason = server.promo_precheck(code, key, hwid, datetime.now())
+    if reason:
+        return json_response(*server.promo_result(code, {"reason": reason}))
+    async with get_conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(server.APPLY_PROMO_SQL, (code, key, hwid))
+            row = await cur.fetchone()
+    if row["reason"] == "ok":
+        server.key_cache.invalidate(key)
+    result, status = server.promo_result(code, row)
+    return json_response(result, status)
+
+async def lease_renew(request):
+    if server._lease_signer is None:
+        return json_response({"status": "invalid", "reason": "leases_disabled"}, 404)
+    data = await read_json(request) or {}
+    # список отзыва изредка обновляется из БД синхронно — не в цикле событий
+    result = await run_in_threadpool(
+        server.renew_lease, data.get("lease"), (data.get("hwid") or "").strip()
+    )
+    return json_response(result)
+
+async def lease_public_key(request):
+    if server._lease_signer is None:
+        return json_response({"status": "invalid", "reason": "leases_disabled"}, 404)
+    return json_response({"alg": "Ed25519", "public_key": server.lease_public_key(), "ttl": server.LEASE_TTL})
+
+async def check_update(request):
+    status, body, headers = server.update_response(
+        request.query_params.get("channel"), request.headers.get("if-none-match")
+    )
+    return Response(body, status_code=status, headers=headers, media_type="application/json")
+
+async def promo_redeem(request):
+    await read_json(request)
+    return json_response(server.PROMO_REDEEM_RESPONSE)
+
+async def metrics(request):
+    if server.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {server.METRICS_TOKEN}":
+        return json_response({"status": "invalid", "reason": "unauthorized"}, 401)
+    return Response(server.metrics_payload(), media_type=server.CONTENT_TYPE_LATEST)
+
+class MetricsMiddleware:
+    # латентность, время в БД и число запросов к БД на каждый HTTP-запрос
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = scope["path"] if scope["path"] in ROUTE_PATHS else "unmatched"
+        _route.set(route)
+        server.start_request_stats()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            server.finish_request_stats(route, scope["method"], status)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    server.expiry_sweeper.start()
+    server.promo_catalog.start()
+    try:
+        yield
+    finally:
+        await run_in_threadpool(server.key_writer.stop)
+        await pool.close()
+
+routes = [
+    Route("/check_key", check_key, methods=["POST"]),
+    Route("/check_keys", check_keys, methods=["POST"]),
+    Route("/apply_promo", apply_promo, methods=["POST"]),
+    Route("/check_update", check_update, methods=["GET"]),
+    Route("/promo/redeem", promo_redeem, methods=["POST"]),
+    Route("/lease/renew", lease_renew, methods=["POST"]),
+    Route("/lease/public_key", lease_public_key, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+]
+ROUTE_PATHS = {route.path for route in routes}
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    middleware=[Middleware(MetricsMiddleware)],
+    exception_handlers={HTTPException: http_error},
+)
@@ -0,0 +1,360 @@
+# Нагрузочный стенд для API лицензий.
+#
+#   1) схема:   DATABASE_URL=... flask --app server migrate
+#   2) данные:  python bench.py seed --dsn postgresql://localhost/bench --keys 200000 --reset
+#   3) сервер:  DATABASE_URL=... gunicorn server:app -w 4   (или uvicorn asgi:app)
+#      весь трафик стенда идёт с одного IP: RATE_LIMIT_IP_RATE=0 RATE_LIMIT_HWID_RATE=0
+#   4) прогон:  python bench.py run --dsn ... --url http://127.0.0.1:8000 --concurrency 64 --duration 60
+#
+# Результат прогона — JSON (пропускная способность и p50/p95/p99 по эндпоинтам) для сравнения между коммитами.
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlencode
+
+import psycopg
+
+BENCH_PREFIX = "BENCH"
+BENCH_CREATOR_PREFIX = "bench_creator_"
+
+# ---------------- Данные ----------------
+def seed(args):
+    import server
+    server.DATABASE_URL = args.dsn
+    rnd = random.Random(args.seed)
+    now = datetime.now()
+    # помесячные секции логов на весь период синтетической истории
+    server.maintain_partitions(
+        server.PARTITION_MONTHS_AHEAD, since=(now - timedelta(days=91)).date(), log=lambda *_: None
+    )
+    with psycopg.connect(args.dsn) as conn:
+        with conn.cursor() as cur:
+            if args.reset:
+                # удаляются только данные стенда (префикс BENCH): --dsn может указывать на рабочую БД
+                prefix, creators = BENCH_PREFIX + "%", server.like_prefix(BENCH_CREATOR_PREFIX)
+                for sql, params in (
+                    ("DELETE FROM purchases WHERE key LIKE %s OR code LIKE %s", (prefix, prefix)),
+                    ("DELETE FROM promo_redemptions WHERE key LIKE %s OR code LIKE %s", (prefix, prefix)),
+                    ("DELETE FROM promo_redemption_keys WHERE key LIKE %s OR code LIKE %s", (prefix, prefix)),
+                    ("DELETE FROM referral_archive_stats WHERE code LIKE %s", (prefix,)),
+                    ("DELETE FROM promo_codes WHERE code LIKE %s", (prefix,)),
+                    ("DELETE FROM creators WHERE nickname LIKE %s", (creators,)),
+                    ("DELETE FROM key_events WHERE key LIKE %s", (prefix,)),
+                    ("DELETE FROM lease_revocations WHERE key LIKE %s", (prefix,)),
+                    ("DELETE FROM keys WHERE key LIKE %s", (prefix,)),
+                ):
+                    cur.execute(sql, params)
+
+            # ключи: ~90% привязаны к hwid, ~5% истекли, ~2% выключены
+            with cur.copy("COPY keys (key, expires_at, active, owner, hwid) FROM STDIN") as copy:
+                for i in range(args.keys):
+                    expired = rnd.random() < 0.05
+                    expires_at = now + timedelta(days=-rnd.randint(1, 60) if expired else rnd.randint(1, 365))
+                    copy.write_row((
+                        f"{BENCH_PREFIX}{i:08d}",
+                        expires_at,
+                        rnd.random() >= 0.02,
+                        f"owner{rnd.randrange(max(args.keys // 20, 1))}",
+                        f"HW{i}" if rnd.random() < 0.9 else "",
+                    ))
+
+            nicknames = [f"{BENCH_CREATOR_PREFIX}{i}" for i in range(args.creators)]
+            with cur.copy("COPY creators (nickname, commission_percent, active) FROM STDIN") as copy:
+                for nickname in nicknames:
+                    copy.write_row((nickname, rnd.choice((5, 10, 15, 20)), True))
+            cur.execute("SELECT id, nickname FROM creators WHERE nickname = ANY(%s)", (nicknames,))
+            creator_ids = {nickname: id for id, nickname in cur.fetchall()}
+            creator_ids = [creator_ids[nickname] for nickname in nicknames]
+
+            with cur.copy(
+                "COPY promo_codes (code, creator_id, bonus_days, max_uses, active, start_at, only_new_users) FROM STDIN"
+            ) as copy:
+                for i in range(args.codes):
+                    copy.write_row((
+                        f"{BENCH_PREFIX}P{i}",
+                        creator_ids[rnd.randint(1, args.creators) - 1] if args.creators else None,
+                        rnd.choice((3, 7, 14)),
+                        0,
+                        True,
+                        now - timedelta(days=90),
+                        False,
+                    ))
+
+            # одно применение на связку code+key+hwid
+            used = set()
+            with cur.copy("COPY promo_redemptions (code, key, hwid, redeemed_at) FROM STDIN") as copy:
+                for _ in range(min(args.redemptions, args.keys * max(args.codes, 1))):
+                    code, k = rnd.randrange(args.codes), rnd.randrange(args.keys)
+                    if (code, k) in used:
+                        continue
+                    used.add((code, k))
+                    copy.write_row((
+                        f"{BENCH_PREFIX}P{code}", f"{BENCH_PREFIX}{k:08d}", f"HW{k}",
+                        now - timedelta(seconds=rnd.randint(0, 90 * 86400)),
+                    ))
+
+            with cur.copy("COPY purchases (key, amount, code, creator_id, purchased_at) FROM STDIN") as copy:
+                for _ in range(args.purchases):
+                    code = rnd.randrange(args.codes) if args.codes and rnd.random() < 0.5 else None
+                    copy.write_row((
+                        f"{BENCH_PREFIX}{rnd.randrange(args.keys):08d}",
+                        rnd.choice((4.99, 9.99, 19.99)),
+                        f"{BENCH_PREFIX}P{code}" if code is not None else None,
+                        None,
+                        now - timedelta(seconds=rnd.randint(0, 90 * 86400)),
+                    ))
+            cur.execute("""
+                UPDATE purchases p SET creator_id = c.creator_id,
+                       commission = ROUND(p.amount * COALESCE(a.commission_percent, 0) / 100.0, 2)
+                FROM promo_codes c LEFT JOIN creators a ON a.id = c.creator_id
+                WHERE c.code = p.code AND p.creator_id IS NULL AND p.key LIKE %s
+            """, (BENCH_PREFIX + "%",))
+
+            # счётчики и агрегаты, которые в проде ведутся инкрементально
+            cur.execute("""
+                INSERT INTO promo_redemption_keys (key, code, hwid)
+                SELECT DISTINCT key, code, hwid FROM promo_redemptions WHERE code LIKE %s
+                ON CONFLICT DO NOTHING
+            """, (BENCH_PREFIX + "%",))
+            cur.execute("""
+                UPDATE promo_codes p SET uses = r.cnt
+                FROM (SELECT code, COUNT(*) AS cnt FROM promo_redemptions WHERE code LIKE %s GROUP BY code) r
+                WHERE r.code = p.code
+            """, (BENCH_PREFIX + "%",))
+            for statement in server.REBUILD_REFERRAL_STATS_SQL:
+                cur.execute(statement)
+        conn.commit()
+        conn.execute("ANALYZE")
+    print(json.dumps({
+        "seeded": {
+            "keys": args.keys, "creators": args.creators, "codes": args.codes,
+            "redemptions": len(used), "purchases": args.purchases,
+        }
+    }))
+
+# ---------------- Нагрузка ----------------
+class Client:
+    # одно keep-alive соединение на поток
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port
+        self.https = parts.scheme == "https"
+        self.timeout = timeout
+        self.cookie = ""
+        self.conn = None
+
+    def request(self, method, path, body=None, form=None):
+        headers = {}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            if self.conn is None:
+                cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.conn = cls(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                cookie = response.getheader("Set-Cookie")
+                if cookie:
+                    self.cookie = cookie.split(";", 1)[0]
+                return response.status
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+def load_targets(dsn, sample):
+    with psycopg.connect(dsn) as conn:
+        keys = conn.execute(
+            "SELECT key, hwid FROM keys WHERE key LIKE %s AND hwid <> '' ORDER BY random() LIMIT %s",
+            (BENCH_PREFIX + "%", sample)
+        ).fetchall()
+        codes = [row[0] for row in conn.execute(
+            "SELECT code FROM promo_codes WHERE code LIKE %s", (BENCH_PREFIX + "%",)
+        )]
+    if not keys:
+        sys.exit("no seeded keys found: run `python bench.py seed` first")
+    return keys, codes
+
+def scenario_heartbeat(client, rnd, targets):
+    key, hwid = rnd.choice(targets["keys"])
+    return "POST /check_key", client.request("POST", "/check_key", {"key": key, "hwid": hwid})
+
+def scenario_batch(client, rnd, targets):
+    items = [{"key": k, "hwid": h} for k, h in rnd.sample(targets["keys"], min(20, len(targets["keys"])))]
+    return "POST /check_keys", client.request("POST", "/check_keys", {"keys": items})
+
+def scenario_promo(client, rnd, targets):
+    # всплеск промо: большинство применений приходится на пару «горячих» кодов
+    codes = targets["codes"]
+    code = rnd.choice(codes[:2] if rnd.random() < 0.8 else codes) if codes else "NOPE"
+    key, hwid = rnd.choice(targets["keys"])
+    return "POST /apply_promo", client.request("POST", "/apply_promo", {"code": code, "key": key, "hwid": hwid})
+
+def scenario_update(client, rnd, targets):
+    return "GET /check_update", client.request("GET", "/check_update")
+
+def scenario_admin(client, rnd, targets):
+    if not client.cookie:
+        client.request("POST", "/", form={"password": targets["admin_password"]})
+    path = rnd.choice(("/dashboard", "/referrals"))
+    return "GET " + path, client.request("GET", path)
+
+SCENARIOS = {
+    "heartbeat": scenario_heartbeat,
+    "batch": scenario_batch,
+    "promo": scenario_promo,
+    "update": scenario_update,
+    "admin": scenario_admin,
+}
+
+def percentile(values, p):
+    if not values:
+        return None
+    # nearest-rank
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return round(values[index] * 1000, 3)
+
+def summarize(samples, elapsed):
+    report = {}
+    for endpoint, items in sorted(samples.items()):
+        latencies = sorted(seconds for seconds, _ in items)
+        statuses = {}
+        for _, status in items:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report[endpoint] = {
+            "requests": len(items),
+            "errors": sum(1 for _, status in items if status == "error" or status >= 500),
+            "throughput_rps": round(len(items) / elapsed, 2),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+            "statuses": statuses,
+        }
+    return report
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args):
+    mix = {}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            sys.exit(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    names, weights = list(mix), list(mix.values())
+
+    keys, codes = load_targets(args.dsn, args.sample)
+    targets = {"keys": keys, "codes": codes, "admin_password": args.admin_password}
+
+    samples = {}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    warmup_until = started + args.warmup
+    stop_at = warmup_until + args.duration
+
+    def worker(n):
+        rnd = random.Random(args.seed * 1000 + n)
+        client = Client(args.url, args.timeout)
+        local = {}
+        while True:
+            t0 = time.perf_counter()
+            if t0 >= stop_at:
+                break
+            scenario = rnd.choices(names, weights)[0]
+            try:
+                endpoint, status = SCENARIOS[scenario](client, rnd, targets)
+            except (http.client.HTTPException, OSError):
+                endpoint, status = scenario, "error"
+            t1 = time.perf_counter()
+            if t0 >= warmup_until:
+                local.setdefault(endpoint, []).append((t1 - t0, status))
+        with lock:
+            for endpoint, items in local.items():
+                samples.setdefault(endpoint, []).extend(items)
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = args.duration
+
+    all_items = [item for items in samples.values() for item in items]
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "params": {
+            "url": args.url, "concurrency": args.concurrency, "duration": args.duration,
+            "warmup": args.warmup, "mix": mix, "seed": args.seed,
+        },
+        "total": summarize({"all": all_items}, elapsed)["all"] if all_items else None,
+        "endpoints": summarize(samples, elapsed),
+    }
+    out = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+    print(out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд API лицензий")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("seed", help="заполнить БД синтетическими данными")
+    # без значения по умолчанию: DATABASE_URL в окружении может оказаться рабочей БД
+    p.add_argument("--dsn", required=True)
+    p.add_argument("--keys", type=int, default=100000)
+    p.add_argument("--creators", type=int, default=50)
+    p.add_argument("--codes", type=int, default=200)
+    p.add_argument("--redemptions", type=int, default=200000)
+    p.add_argument("--purchases", type=int, default=50000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--reset", action="store_true", help="удалить прошлые данные стенда (префикс BENCH) перед заполнением")
+
+    p = sub.add_parser("run", help="прогнать нагрузку и вывести JSON-отчёт")
+    p.add_argument("--dsn", default=os.getenv("DATABASE_URL"))
+    p.add_argument("--url", default="http://127.0.0.1:5000")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--duration", type=float, default=30)
+    p.add_argument("--warmup", type=float, default=3)
+    p.add_argument("--mix", default="heartbeat=90,batch=2,promo=4,update=3,admin=1")
+    p.add_argument("--sample", type=int, default=20000, help="сколько ключей брать в пул для запросов")
+    p.add_argument("--timeout", type=float, default=10)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--admin-password", default="12345az")
+    p.add_argument("--out", help="куда дополнительно записать JSON")
+
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("--dsn or DATABASE_URL is required")
+    {"seed": seed, "run": run}[args.command](args)
+
+if __name__ == "__main__":
+    main()
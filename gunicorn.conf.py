@@ -0,0 +1,18 @@
+# gunicorn подхватывает этот файл из рабочего каталога автоматически
+import os
+
+
+def child_exit(server, worker):
+    # метрики умершего воркера в режиме PROMETHEUS_MULTIPROC_DIR больше не пишутся
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # дописать очередь last_seen/привязок до остановки воркера
+    # (без --preload модуль в мастере не загружен, импорт идёт уже в воркере)
+    import sys
+    app_module = sys.modules.get("server")
+    if app_module is not None:
+        app_module.key_writer.stop()
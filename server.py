@@ -1,108 +1,2192 @@
 import os
+import io
+import re
+import gzip
+import base64
+import hashlib
+import csv
+import json
+import secrets
+import atexit
+import threading
+import time
+import contextlib
+import contextvars
+from collections import OrderedDict
+import click
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.exceptions import InvalidSignature
 import psycopg
 from psycopg.rows import dict_row
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-import random
+from psycopg_pool import ConnectionPool, PoolTimeout
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, jsonify, Response, has_request_context
+)
 import string
+import math
 from math import floor
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "supersecretkey")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Пул соединений с БД (отдельный на каждый воркер gunicorn)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))
+DB_POOL_CHECK = os.getenv("DB_POOL_CHECK", "1") == "1"
+
+# Реплика для чтения (админские страницы, выгрузки); без неё всё идёт в DATABASE_URL.
+# Проверка ключей всегда читает primary: строки попадают в key_cache, и отставание реплики
+# продлило бы жизнь отозванного ключа на lag + KEY_CACHE_TTL.
+# Сессия админа после записи REPLICA_STALENESS секунд читает с primary (видит свои изменения);
+# при отставании реплики больше REPLICA_MAX_LAG секунд или её недоступности чтение уходит на primary.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
+REPLICA_STALENESS = float(os.getenv("REPLICA_STALENESS", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "1"))
+REPLICA_ACQUIRE_TIMEOUT = float(os.getenv("REPLICA_ACQUIRE_TIMEOUT", "1"))
+
+# Кэш проверок ключей внутри воркера (0 — выключен)
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", "10000"))
+KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", "30"))
+
+# Максимум ключей в одном запросе /check_keys
+CHECK_KEYS_MAX = int(os.getenv("CHECK_KEYS_MAX", "200"))
+
+# Размер страницы списка ключей (дашборд и /api/keys)
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "100"))
+API_PAGE_SIZE_MAX = int(os.getenv("API_PAGE_SIZE_MAX", "500"))
+
+# Максимум ключей за одну массовую генерацию
+BULK_KEYS_MAX = int(os.getenv("BULK_KEYS_MAX", "100000"))
+
+# Офлайн-лизы: base64 32-байтного seed Ed25519; без ключа лизы не выдаются
+LEASE_PRIVATE_KEY = os.getenv("LEASE_PRIVATE_KEY", "")
+LEASE_TTL = int(os.getenv("LEASE_TTL", "21600"))
+LEASE_REVOCATION_REFRESH = float(os.getenv("LEASE_REVOCATION_REFRESH", "5"))
+
+# Сколько строк выгрузка забирает из серверного курсора за раз
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "2000"))
+
 UPDATE_VERSION = os.getenv("LATEST_VERSION", "1.0.0")
 UPDATE_URL = os.getenv("DOWNLOAD_URL", "")
 UPDATE_SHA256 = os.getenv("UPDATE_SHA256", "")
 UPDATE_CHANGELOG = os.getenv("UPDATE_CHANGELOG", "")
+# JSON-файл с манифестами по каналам: {"stable": {...}, "beta": {...}};
+# без файла канал stable собирается из переменных выше
+UPDATE_MANIFEST_PATH = os.getenv("UPDATE_MANIFEST_PATH", "")
+UPDATE_MANIFEST_RELOAD = float(os.getenv("UPDATE_MANIFEST_RELOAD", "10"))
+UPDATE_CACHE_MAX_AGE = int(os.getenv("UPDATE_CACHE_MAX_AGE", "60"))
+
+# Отложенная запись из /check_key: last_seen и версия клиента копятся в памяти воркера
+# и пишутся одним UPDATE раз в WRITE_BEHIND_INTERVAL секунд или по набору WRITE_BEHIND_BATCH ключей.
+# Первая привязка hwid ждёт в очереди не дольше WRITE_BEHIND_BIND_WAIT секунд и уходит общим UPDATE.
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "2"))
+WRITE_BEHIND_BIND_WAIT = float(os.getenv("WRITE_BEHIND_BIND_WAIT", "0.005"))
+
+# Bloom-фильтр существующих ключей: заведомо несуществующий ключ отсекается без запроса к БД.
+# Новые ключи других процессов приходят оповещением по CHANGES_CHANNEL,
+# полная перестройка (размер, удалённые ключи) — раз в KEY_FILTER_REBUILD секунд.
+KEY_FILTER_ENABLED = os.getenv("KEY_FILTER_ENABLED", "1") == "1"
+KEY_FILTER_FP_RATE = float(os.getenv("KEY_FILTER_FP_RATE", "0.01"))
+KEY_FILTER_REBUILD = float(os.getenv("KEY_FILTER_REBUILD", "3600"))
+
+# Token bucket на клиента для /check_key, /check_keys, /apply_promo (запросов в секунду и запас).
+# Считается в памяти воркера; 0 — без ограничения. Лимит по IP по умолчанию выключен: за nginx
+# или роутером платформы без TRUST_PROXY_HEADERS все клиенты делят одно ведро адреса прокси.
+RATE_LIMIT_IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", "0"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "500"))
+RATE_LIMIT_HWID_RATE = float(os.getenv("RATE_LIMIT_HWID_RATE", "1"))
+RATE_LIMIT_HWID_BURST = float(os.getenv("RATE_LIMIT_HWID_BURST", "20"))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "0") == "1"
+
+# Помесячные секции promo_redemptions/purchases (flask --app server partitions, по cron):
+# секции создаются на PARTITION_MONTHS_AHEAD месяцев вперёд; секции старше PARTITION_ARCHIVE_AFTER
+# месяцев (0 — не трогать) выгружаются в PARTITION_ARCHIVE_DIR как csv.gz и удаляются,
+# а без каталога только отсоединяются от таблицы.
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_ARCHIVE_AFTER = int(os.getenv("PARTITION_ARCHIVE_AFTER", "0"))
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "")
+
+# Снимок промокодов в памяти воркера: обновляется по NOTIFY из админки (канал CHANGES_CHANNEL)
+# и на всякий случай не реже раза в PROMO_CATALOG_MAX_AGE секунд. Сам слушатель канала работает
+# и при PROMO_CATALOG_ENABLED=0: через него же сбрасывается кэш ключей.
+PROMO_CATALOG_ENABLED = os.getenv("PROMO_CATALOG_ENABLED", "1") == "1"
+PROMO_CATALOG_MAX_AGE = float(os.getenv("PROMO_CATALOG_MAX_AGE", "60"))
+
+# Приём покупок пачкой от платёжного провайдера: POST /api/purchases/batch
+# с Authorization: Bearer INGEST_TOKEN (или из админской сессии)
+INGEST_TOKEN = os.getenv("INGEST_TOKEN", "")
+PURCHASE_BATCH_MAX = int(os.getenv("PURCHASE_BATCH_MAX", "1000"))
+
+# Истёкшие ключи выключаются фоновым проходом раз в EXPIRY_SWEEP_INTERVAL секунд
+# пачками по EXPIRY_SWEEP_BATCH (или вручную: flask --app server sweep-expired)
+EXPIRY_SWEEP_ENABLED = os.getenv("EXPIRY_SWEEP_ENABLED", "1") == "1"
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "60"))
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", "1000"))
+
+# Метрики: /metrics в формате Prometheus. Под gunicorn задайте PROMETHEUS_MULTIPROC_DIR,
+# иначе каждый воркер отдаёт только свои счётчики. METRICS_TOKEN — Bearer для /metrics.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Запросы дольше порога пишутся в лог с разбивкой по SQL (0 — выключено)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+class UpdateManifests:
+    # Манифесты сериализуются один раз при загрузке; на запрос отдаются готовые байты и ETag.
+    # Файл перечитывается, если изменился его mtime (проверка не чаще UPDATE_MANIFEST_RELOAD).
+    def __init__(self, path):
+        self.path = path
+        self._channels = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.path:
+            with open(self.path, encoding="utf-8") as f:
+                channels = json.load(f)
+        else:
+            channels = {"stable": {
+                "version": UPDATE_VERSION,
+                "url": UPDATE_URL,
+                "sha256": UPDATE_SHA256,
+                "changelog": UPDATE_CHANGELOG
+            }}
+        compiled = {}
+        for name, manifest in channels.items():
+            # тот же вид, что у jsonify: сортировка ключей, компактно, \n в конце
+            body = (app.json.dumps(manifest, separators=(",", ":")) + "\n").encode()
+            compiled[name] = (body, '"%s"' % hashlib.sha256(body).hexdigest()[:32])
+        return compiled
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self._channels and now - self._checked_at < UPDATE_MANIFEST_RELOAD:
+            return
+        with self._lock:
+            if self._channels and now - self._checked_at < UPDATE_MANIFEST_RELOAD:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime if self.path else None
+                if self._channels and mtime == self._mtime:
+                    return
+                self._mtime = mtime
+                self._channels = self._load()
+            except (OSError, ValueError):
+                # битый файл при выкладке: продолжаем отдавать последний удачный манифест
+                app.logger.exception("failed to load update manifest %s", self.path)
+                if not self._channels:
+                    raise
+
+    def get(self, channel):
+        self._maybe_reload()
+        return self._channels.get(channel)
+
+update_manifests = UpdateManifests(UPDATE_MANIFEST_PATH)
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match: список ETag через запятую или *, слабое сравнение (W/ игнорируется)
+    for candidate in (if_none_match or "").split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def update_response(channel, if_none_match):
+    # (status, body, headers) для /check_update
+    manifest = update_manifests.get(channel or "stable")
+    if manifest is None:
+        body = (app.json.dumps({"status": "invalid", "reason": "unknown_channel"}, separators=(",", ":")) + "\n").encode()
+        return 404, body, {}
+    body, etag = manifest
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={UPDATE_CACHE_MAX_AGE}"}
+    if etag_matches(if_none_match, etag):
+        return 304, b"", headers
+    return 200, body, headers
 
 # Добавьте этот endpoint в server.py
 @app.route("/check_update", methods=["GET"])
 def check_update():
-    return jsonify({
-        "version": UPDATE_VERSION,
-        "url": UPDATE_URL,
-        "sha256": UPDATE_SHA256,
-        "changelog": UPDATE_CHANGELOG
-    })
+    status, body, headers = update_response(
+        request.args.get("channel"), request.headers.get("If-None-Match")
+    )
+    return Response(body, status=status, headers=headers, mimetype="application/json")
+
+# ---------------- Метрики ----------------
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency", ["route", "method", "status"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Time spent in a single SQL statement", ["route"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds", "Total SQL time per request", ["route"]
+)
+DB_ROUND_TRIPS = Histogram(
+    "db_round_trips_per_request", "SQL statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+)
+DB_ACQUIRE_LATENCY = Histogram(
+    "db_pool_acquire_seconds", "Time waiting for a pooled connection", ["route"],
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10)
+)
+OUTCOMES = Counter(
+    "license_outcomes_total", "Client API results by reason", ["route", "reason"]
+)
+KEY_WRITER_FLUSH_LATENCY = Histogram(
+    "key_writer_flush_seconds", "Write-behind flush duration", ["kind"]
+)
+KEY_WRITER_BATCH_SIZE = Histogram(
+    "key_writer_batch_keys", "Keys per write-behind flush", ["kind"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+
+# Счётчики текущего запроса: кладутся в контекст (поток Flask или задача asyncio)
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+def start_request_stats():
+    stats = {"started": time.perf_counter(), "queries": [], "acquire": 0.0}
+    _request_stats.set(stats)
+    return stats
+
+def record_query(query, seconds):
+    stats = _request_stats.get()
+    # пустой запрос — проверка соединения пулом, она входит во время получения соединения
+    if stats is not None and query:
+        stats["queries"].append((query, seconds))
+
+def record_acquire(seconds):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats["acquire"] += seconds
+
+def record_outcome(route, payload):
+    if isinstance(payload, dict):
+        for result in payload.get("results") or [payload]:
+            OUTCOMES.labels(route, result.get("reason") or result.get("status") or "unknown").inc()
+
+def finish_request_stats(route, method, status):
+    stats = _request_stats.get()
+    if stats is None:
+        return
+    _request_stats.set(None)
+    duration = time.perf_counter() - stats["started"]
+    db_time = sum(seconds for _, seconds in stats["queries"])
+    REQUEST_LATENCY.labels(route, method, status).observe(duration)
+    DB_TIME_PER_REQUEST.labels(route).observe(db_time)
+    DB_ROUND_TRIPS.labels(route).observe(len(stats["queries"]))
+    for _, seconds in stats["queries"]:
+        DB_QUERY_LATENCY.labels(route).observe(seconds)
+    if stats["acquire"]:
+        DB_ACQUIRE_LATENCY.labels(route).observe(stats["acquire"])
+    if SLOW_REQUEST_MS and duration * 1000 >= SLOW_REQUEST_MS:
+        breakdown = "; ".join(
+            f"{seconds * 1000:.1f}ms {' '.join(str(query).split())[:200]}"
+            for query, seconds in stats["queries"]
+        )
+        app.logger.warning(
+            "slow request %s %s %s: %.1fms, db %.1fms in %d queries, pool wait %.1fms | %s",
+            method, route, status, duration * 1000, db_time * 1000, len(stats["queries"]),
+            stats["acquire"] * 1000, breakdown
+        )
+
+class TimedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+    def executemany(self, query, params_seq, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+class AsyncTimedCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+def metrics_payload():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+# клиентские эндпоинты, для которых считаем исходы по reason
+OUTCOME_ENDPOINTS = {"check_key", "check_keys", "apply_promo", "lease_renew"}
+
+@app.before_request
+def before_request_metrics():
+    start_request_stats()
+
+@app.after_request
+def after_request_metrics(response):
+    route = request_route()
+    if request.endpoint in OUTCOME_ENDPOINTS and response.is_json:
+        record_outcome(route, response.get_json(silent=True))
+    finish_request_stats(route, request.method, response.status_code)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    return Response(metrics_payload(), mimetype=CONTENT_TYPE_LATEST)
+
+# роль ("primary" / "replica") -> (pid, пул)
+_pools = {}
+_pool_lock = threading.Lock()
+# пулы, унаследованные от мастера после fork: держим ссылки, чтобы сборщик мусора
+# не закрыл из воркера сокеты, которые принадлежат родительскому процессу
+_inherited_pools = []
+
+def _get_pool(role, conninfo, **kwargs):
+    pid = os.getpid()
+    entry = _pools.get(role)
+    if entry is not None and entry[0] == pid:
+        return entry[1]
+    with _pool_lock:
+        entry = _pools.get(role)
+        if entry is None or entry[0] != pid:
+            if entry is not None:
+                _inherited_pools.append(entry[1])
+            pool = ConnectionPool(
+                conninfo,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                check=ConnectionPool.check_connection if DB_POOL_CHECK else None,
+                kwargs={"row_factory": dict_row, "cursor_factory": TimedCursor, **kwargs},
+                name=f"crossfocusx-{role}-{pid}",
+                open=True,
+            )
+            entry = _pools[role] = (pid, pool)
+    return entry[1]
 
-def get_conn():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+def get_pool():
+    return _get_pool("primary", DATABASE_URL)
 
-def init_db():
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            # keys — как у тебя
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS keys (
-                    id SERIAL PRIMARY KEY,
-                    key TEXT UNIQUE,
-                    expires_at TIMESTAMP,
-                    active BOOLEAN DEFAULT TRUE,
-                    owner TEXT DEFAULT '',
-                    hwid TEXT DEFAULT ''
-                )
-            """)
+def get_replica_pool():
+    # транзакции на реплике только читающие: случайная запись упадёт, а не разойдётся с primary
+    return _get_pool("replica", DATABASE_REPLICA_URL, options="-c default_transaction_read_only=on")
 
+@contextlib.contextmanager
+def get_conn():
+    # соединение возвращается в пул при выходе из with (commit, либо rollback при исключении)
+    started = time.perf_counter()
+    with get_pool().connection() as conn:
+        record_acquire(time.perf_counter() - started)
+        yield conn
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+"""
+
+class ReplicaMonitor:
+    # Фоновый поток воркера раз в REPLICA_CHECK_INTERVAL меряет отставание реплики
+    # по своему соединению (не из пула). Пока первой проверки не было, реплика считается непригодной.
+    def __init__(self, max_lag, interval):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lag = None
+        self.healthy = False
+        self.error = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.lag, self.healthy, self.error = None, False, None
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="replica-monitor", daemon=True).start()
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg.connect(DATABASE_REPLICA_URL, autocommit=True, connect_timeout=5)
+                self.lag = float(conn.execute(REPLICA_LAG_SQL).fetchone()[0])
+                self._set_healthy(self.lag <= self.max_lag, None if self.lag <= self.max_lag else "lag")
+            except psycopg.Error as e:
+                self._set_healthy(False, str(e).strip() or e.__class__.__name__)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            time.sleep(self.interval)
+
+    def _set_healthy(self, healthy, error):
+        if healthy != self.healthy:
+            app.logger.warning("replica %s (lag %s): %s", "up" if healthy else "down", self.lag, error or "ok")
+        self.healthy, self.error = healthy, error
+
+    def mark_down(self, reason):
+        # до следующей проверки читаем с primary
+        self._set_healthy(False, reason)
+
+    def ok(self):
+        self._ensure_thread()
+        return self.healthy
+
+    def stats(self):
+        return {"configured": True, "healthy": self.healthy, "lag": self.lag, "error": self.error}
+
+replica_monitor = ReplicaMonitor(REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL)
+
+# GET-роуты админки, которые меняют данные
+WRITE_ENDPOINTS = {"activate_key", "deactivate_key", "reset_hwid", "creator_toggle", "promo_toggle"}
+
+def use_replica():
+    if not DATABASE_REPLICA_URL:
+        return False
+    if has_request_context() and time.time() - session.get("db_write_at", 0) < REPLICA_STALENESS:
+        return False
+    return replica_monitor.ok()
+
+@app.after_request
+def remember_admin_write(response):
+    # read-your-writes: после изменений админ какое-то время читает с primary.
+    # Без cookie сессию не трогаем: иначе Flask ставит Vary: Cookie и CDN не кэширует /check_update
+    if app.config["SESSION_COOKIE_NAME"] not in request.cookies:
+        return response
+    if session.get("admin") and (request.method not in ("GET", "HEAD") or request.endpoint in WRITE_ENDPOINTS):
+        session["db_write_at"] = time.time()
+    return response
+
+@contextlib.contextmanager
+def get_read_conn(replica=None):
+    # соединение для запросов только на чтение: реплика, если она сейчас пригодна, иначе primary.
+    # replica задают явно, когда решение принимается в запросе, а чтение идёт позже (стриминг)
+    if replica is None:
+        replica = use_replica()
+    with contextlib.ExitStack() as stack:
+        conn = None
+        if replica:
+            started = time.perf_counter()
+            try:
+                conn = stack.enter_context(get_replica_pool().connection(timeout=REPLICA_ACQUIRE_TIMEOUT))
+                record_acquire(time.perf_counter() - started)
+            except PoolTimeout:
+                replica_monitor.mark_down("pool timeout")
+        if conn is None:
+            conn = stack.enter_context(get_conn())
+        yield conn
+
+def pool_stats():
+    stats = get_pool().get_stats()
+    return {
+        "size": stats.get("pool_size", 0),
+        "available": stats.get("pool_available", 0),
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+        "requests": stats.get("requests_num", 0),
+        "requests_queued": stats.get("requests_queued", 0),
+        "wait_ms": stats.get("requests_wait_ms", 0),
+        "errors": stats.get("requests_errors", 0),
+        "connections_created": stats.get("connections_num", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+    }
+
+# ---------------- Миграции схемы ----------------
+# Применяются один раз при деплое: flask --app server migrate
+# Версия записывается в schema_migrations; новые изменения схемы — только новой миграцией в конец списка.
+# "sql" выполняется в одной транзакции, затем "indexes" — по одному через CREATE INDEX CONCURRENTLY
+# (третий элемент True — уникальный индекс), затем "drop_indexes" — через DROP INDEX CONCURRENTLY.
+# Без индексов версия записывается в той же транзакции, что и "sql". С индексами — после них,
+# поэтому "sql" такой миграции должен переживать повтор после обрыва (IF NOT EXISTS).
+# "rebuild_stats": True — после всех миграций и SQL_FUNCTIONS один раз пересчитать агрегаты /referrals
+# по итоговой схеме; если migrate прервался до пересчёта, агрегаты чинит flask --app server rebuild-stats.
+MIGRATION_LOCK_ID = 72010001
+
+# Пересчёт агрегатов /referrals из сырых логов (flask --app server rebuild-stats);
+# выгруженные в архив секции учитываются через referral_archive_stats
+REBUILD_REFERRAL_STATS_SQL = [
+    "LOCK TABLE promo_redemptions, purchases IN SHARE MODE",
+    "TRUNCATE promo_code_stats, creator_stats, referral_daily_stats",
+    """
+    INSERT INTO promo_code_stats (code, redemptions, purchases, revenue)
+    SELECT code, SUM(redemptions), SUM(purchases), SUM(revenue) FROM (
+        SELECT code, COUNT(*) AS redemptions, 0 AS purchases, 0 AS revenue
+        FROM promo_redemptions GROUP BY code
+        UNION ALL
+        SELECT code, 0, COUNT(*), SUM(amount)
+        FROM purchases WHERE code IS NOT NULL AND code <> '' GROUP BY code
+        UNION ALL
+        SELECT code, SUM(redemptions), SUM(purchases), SUM(revenue)
+        FROM referral_archive_stats WHERE code <> '' GROUP BY code
+    ) t
+    GROUP BY code
+    """,
+    """
+    INSERT INTO creator_stats (creator_id, redemptions, purchases, revenue, commission)
+    SELECT creator_id, SUM(redemptions), SUM(purchases), SUM(revenue), SUM(commission) FROM (
+        SELECT p.creator_id, COUNT(*) AS redemptions, 0 AS purchases, 0 AS revenue, 0 AS commission
+        FROM promo_redemptions r JOIN promo_codes p ON p.code = r.code
+        WHERE p.creator_id IS NOT NULL GROUP BY p.creator_id
+        UNION ALL
+        SELECT creator_id, 0, COUNT(*), SUM(amount), SUM(commission)
+        FROM purchases WHERE creator_id IS NOT NULL GROUP BY creator_id
+        UNION ALL
+        SELECT creator_id, SUM(redemptions), SUM(purchases), SUM(revenue), SUM(commission)
+        FROM referral_archive_stats WHERE creator_id IN (SELECT id FROM creators) GROUP BY creator_id
+    ) t
+    GROUP BY creator_id
+    """,
+    """
+    INSERT INTO referral_daily_stats (day, creator_id, redemptions, purchases, revenue, commission)
+    SELECT day, creator_id, SUM(redemptions), SUM(purchases), SUM(revenue), SUM(commission) FROM (
+        SELECT r.redeemed_at::date AS day, COALESCE(p.creator_id, 0) AS creator_id,
+               COUNT(*) AS redemptions, 0 AS purchases, 0 AS revenue, 0 AS commission
+        FROM promo_redemptions r LEFT JOIN promo_codes p ON p.code = r.code GROUP BY 1, 2
+        UNION ALL
+        SELECT purchased_at::date, COALESCE(creator_id, 0), 0, COUNT(*), SUM(amount), SUM(commission)
+        FROM purchases GROUP BY 1, 2
+        UNION ALL
+        SELECT day, creator_id, redemptions, purchases, revenue, commission FROM referral_archive_stats
+    ) t
+    GROUP BY day, creator_id
+    """,
+]
+
+# Агрегаты секций логов, выгруженных в архив (flask --app server partitions)
+REFERRAL_ARCHIVE_STATS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS referral_archive_stats (
+        day DATE NOT NULL,
+        code TEXT NOT NULL DEFAULT '',
+        creator_id INTEGER NOT NULL DEFAULT 0,
+        redemptions BIGINT NOT NULL DEFAULT 0,
+        purchases BIGINT NOT NULL DEFAULT 0,
+        revenue NUMERIC(14,2) NOT NULL DEFAULT 0
+    )
+"""
+
+# Инкремент агрегатов /referrals в транзакции применения промокода
+# (покупки считаются пачкой в ingest_purchases). Порядок блокировок всегда code -> creator -> day.
+BUMP_REFERRAL_STATS_SQL = """
+CREATE OR REPLACE FUNCTION bump_referral_stats(
+    p_code TEXT, p_creator_id INTEGER, p_redemptions INTEGER, p_purchases INTEGER,
+    p_revenue NUMERIC, p_at TIMESTAMP
+) RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    IF p_code IS NOT NULL AND p_code <> '' THEN
+        INSERT INTO promo_code_stats AS s (code, redemptions, purchases, revenue)
+        VALUES (p_code, p_redemptions, p_purchases, p_revenue)
+        ON CONFLICT (code) DO UPDATE SET
+            redemptions = s.redemptions + EXCLUDED.redemptions,
+            purchases = s.purchases + EXCLUDED.purchases,
+            revenue = s.revenue + EXCLUDED.revenue;
+    END IF;
+    IF p_creator_id IS NOT NULL THEN
+        INSERT INTO creator_stats AS s (creator_id, redemptions, purchases, revenue)
+        VALUES (p_creator_id, p_redemptions, p_purchases, p_revenue)
+        ON CONFLICT (creator_id) DO UPDATE SET
+            redemptions = s.redemptions + EXCLUDED.redemptions,
+            purchases = s.purchases + EXCLUDED.purchases,
+            revenue = s.revenue + EXCLUDED.revenue;
+    END IF;
+    INSERT INTO referral_daily_stats AS s (day, creator_id, redemptions, purchases, revenue)
+    VALUES (p_at::date, COALESCE(p_creator_id, 0), p_redemptions, p_purchases, p_revenue)
+    ON CONFLICT (day, creator_id) DO UPDATE SET
+        redemptions = s.redemptions + EXCLUDED.redemptions,
+        purchases = s.purchases + EXCLUDED.purchases,
+        revenue = s.revenue + EXCLUDED.revenue;
+END;
+$$
+"""
+
+# Вся проверка и применение промокода за один вызов.
+# Строка ключа блокируется FOR UPDATE, поэтому применения для одного ключа
+# идут строго по очереди; лимит max_uses держит условный UPDATE счётчика uses.
+APPLY_PROMO_CODE_SQL = """
+CREATE OR REPLACE FUNCTION apply_promo_code(p_code TEXT, p_key TEXT, p_hwid TEXT)
+RETURNS TABLE (reason TEXT, creator TEXT, bonus_days INTEGER, new_expires_at TIMESTAMP)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    k RECORD;
+    p RECORD;
+    v_now TIMESTAMP := LOCALTIMESTAMP;
+    v_bonus INTEGER;
+    v_expires TIMESTAMP;
+BEGIN
+    SELECT keys.id, keys.expires_at, keys.active, keys.swept_at, COALESCE(keys.hwid, '') AS hwid
+      INTO k FROM keys WHERE keys.key = p_key FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'key_not_found', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF NOT k.active AND k.swept_at IS NULL THEN
+        RETURN QUERY SELECT 'key_inactive', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    -- выключенный expiry sweeper'ом ключ по-прежнему истёкший
+    IF NOT k.active OR k.expires_at <= v_now THEN
+        RETURN QUERY SELECT 'key_expired', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF k.hwid <> '' AND k.hwid <> p_hwid THEN
+        RETURN QUERY SELECT 'hwid_mismatch', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF k.hwid = '' THEN
+        UPDATE keys SET hwid = p_hwid WHERE keys.id = k.id;
+    END IF;
+
+    SELECT pc.id, pc.creator_id, pc.bonus_days, pc.max_uses, pc.uses, pc.active, pc.start_at,
+           pc.end_at, pc.only_new_users, c.nickname
+      INTO p
+      FROM promo_codes pc LEFT JOIN creators c ON c.id = pc.creator_id
+     WHERE pc.code = p_code;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'promo_not_found', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF NOT p.active THEN
+        RETURN QUERY SELECT 'promo_inactive', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF p.start_at IS NOT NULL AND p.start_at > v_now THEN
+        RETURN QUERY SELECT 'promo_not_started', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    IF p.end_at IS NOT NULL AND p.end_at < v_now THEN
+        RETURN QUERY SELECT 'promo_expired', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+
+    -- Антифрод: один раз на связку key+hwid (promo_redemption_keys — без секций и без архивации)
+    IF EXISTS (SELECT 1 FROM promo_redemption_keys r
+               WHERE r.key = p_key AND r.code = p_code AND r.hwid = p_hwid) THEN
+        RETURN QUERY SELECT 'already_redeemed', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    -- быстрый отказ по уже исчерпанному лимиту (окончательно решает UPDATE ниже)
+    IF COALESCE(p.max_uses, 0) > 0 AND p.uses >= p.max_uses THEN
+        RETURN QUERY SELECT 'promo_limit_reached', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+    -- «Только для новых»
+    IF p.only_new_users AND EXISTS (SELECT 1 FROM promo_redemption_keys r WHERE r.key = p_key) THEN
+        RETURN QUERY SELECT 'not_new_user', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+
+    UPDATE promo_codes pc SET uses = pc.uses + 1
+     WHERE pc.id = p.id AND (COALESCE(pc.max_uses, 0) <= 0 OR pc.uses < pc.max_uses);
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'promo_limit_reached', NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP; RETURN;
+    END IF;
+
+    -- Применяем бонус, логируем применение и обновляем агрегаты /referrals
+    v_bonus := COALESCE(NULLIF(p.bonus_days, 0), 7);
+    UPDATE keys SET expires_at = keys.expires_at + make_interval(days => v_bonus)
+     WHERE keys.id = k.id
+    RETURNING keys.expires_at INTO v_expires;
+    INSERT INTO promo_redemption_keys (key, code, hwid) VALUES (p_key, p_code, p_hwid);
+    INSERT INTO promo_redemptions (code, key, hwid, redeemed_at) VALUES (p_code, p_key, p_hwid, v_now);
+    PERFORM bump_referral_stats(p_code, p.creator_id, 1, 0, 0, v_now);
+
+    RETURN QUERY SELECT 'ok', p.nickname, v_bonus, v_expires;
+END;
+$$
+"""
+
+# Оповещение о вставленных ключах для Bloom-фильтров воркеров (KeyFilter): одно на оператор,
+# с диапазоном id — в т.ч. для COPY, импорта и ручных INSERT. Канал — CHANGES_CHANNEL.
+NOTIFY_KEYS_INSERTED_SQL = """
+CREATE OR REPLACE FUNCTION notify_keys_inserted() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    v_first INTEGER;
+    v_last INTEGER;
+BEGIN
+    SELECT MIN(id), MAX(id) INTO v_first, v_last FROM inserted_keys;
+    IF v_first IS NOT NULL THEN
+        PERFORM pg_notify('crossfocusx_changes', 'keys:' || v_first || ':' || v_last);
+    END IF;
+    RETURN NULL;
+END;
+$$
+"""
+
+# Функции БД пересоздаются (CREATE OR REPLACE) при каждом migrate после версионных миграций,
+# поэтому меняются правкой здесь. Смена сигнатуры или RETURNS — через DROP FUNCTION в новой миграции.
+SQL_FUNCTIONS = [
+    BUMP_REFERRAL_STATS_SQL,
+    APPLY_PROMO_CODE_SQL,
+    NOTIFY_KEYS_INSERTED_SQL,
+]
+
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "base tables",
+        "sql": [
+            # keys — как у тебя
+            """
+            CREATE TABLE IF NOT EXISTS keys (
+                id SERIAL PRIMARY KEY,
+                key TEXT UNIQUE,
+                expires_at TIMESTAMP,
+                active BOOLEAN DEFAULT TRUE,
+                owner TEXT DEFAULT '',
+                hwid TEXT DEFAULT ''
+            )
+            """,
             # creators — контент-мейкеры
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS creators (
-                    id SERIAL PRIMARY KEY,
-                    nickname TEXT UNIQUE NOT NULL,
-                    yt_url TEXT DEFAULT '',
-                    tt_url TEXT DEFAULT '',
-                    ig_url TEXT DEFAULT '',
-                    commission_percent INTEGER DEFAULT 10,
-                    active BOOLEAN DEFAULT TRUE,
-                    note TEXT DEFAULT ''
-                )
-            """)
-
+            """
+            CREATE TABLE IF NOT EXISTS creators (
+                id SERIAL PRIMARY KEY,
+                nickname TEXT UNIQUE NOT NULL,
+                yt_url TEXT DEFAULT '',
+                tt_url TEXT DEFAULT '',
+                ig_url TEXT DEFAULT '',
+                commission_percent INTEGER DEFAULT 10,
+                active BOOLEAN DEFAULT TRUE,
+                note TEXT DEFAULT ''
+            )
+            """,
             # promo_codes — сами промокоды
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS promo_codes (
-                    id SERIAL PRIMARY KEY,
-                    code TEXT UNIQUE NOT NULL,
-                    creator_id INTEGER REFERENCES creators(id) ON DELETE SET NULL,
-                    bonus_days INTEGER DEFAULT 7,
-                    max_uses INTEGER DEFAULT 0,
-                    active BOOLEAN DEFAULT TRUE,
-                    start_at TIMESTAMP DEFAULT NOW(),
-                    end_at TIMESTAMP,
-                    only_new_users BOOLEAN DEFAULT FALSE,
-                    note TEXT DEFAULT ''
-                )
-            """)
-
+            """
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                id SERIAL PRIMARY KEY,
+                code TEXT UNIQUE NOT NULL,
+                creator_id INTEGER REFERENCES creators(id) ON DELETE SET NULL,
+                bonus_days INTEGER DEFAULT 7,
+                max_uses INTEGER DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE,
+                start_at TIMESTAMP DEFAULT NOW(),
+                end_at TIMESTAMP,
+                only_new_users BOOLEAN DEFAULT FALSE,
+                note TEXT DEFAULT ''
+            )
+            """,
             # promo_redemptions — лог применений промокодов
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS promo_redemptions (
-                    id SERIAL PRIMARY KEY,
-                    code TEXT NOT NULL,
-                    key TEXT NOT NULL,
-                    hwid TEXT NOT NULL,
-                    redeemed_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
-
+            """
+            CREATE TABLE IF NOT EXISTS promo_redemptions (
+                id SERIAL PRIMARY KEY,
+                code TEXT NOT NULL,
+                key TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                redeemed_at TIMESTAMP DEFAULT NOW()
+            )
+            """,
             # purchases — учёт покупок (для комиссий)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS purchases (
-                    id SERIAL PRIMARY KEY,
-                    key TEXT NOT NULL,
-                    amount NUMERIC(10,2) NOT NULL,
-                    code TEXT,
-                    creator_id INTEGER REFERENCES creators(id),
-                    purchased_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
-            conn.commit()
-
-init_db()
+            """
+            CREATE TABLE IF NOT EXISTS purchases (
+                id SERIAL PRIMARY KEY,
+                key TEXT NOT NULL,
+                amount NUMERIC(10,2) NOT NULL,
+                code TEXT,
+                creator_id INTEGER REFERENCES creators(id),
+                purchased_at TIMESTAMP DEFAULT NOW()
+            )
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "name": "dashboard filter indexes",
+        "indexes": [
+            ("keys_key_prefix_idx", "keys (key text_pattern_ops)"),
+            ("keys_owner_prefix_idx", "keys (lower(owner) text_pattern_ops)"),
+            ("keys_hwid_idx", "keys (hwid)"),
+            ("keys_expires_at_idx", "keys (expires_at)"),
+        ],
+    },
+    {
+        "version": 3,
+        "name": "promo and purchase indexes",
+        "indexes": [
+            # (code, key, hwid) покрывает и поиск/группировку только по code
+            ("promo_redemptions_code_key_hwid_idx", "promo_redemptions (code, key, hwid)"),
+            ("promo_redemptions_key_idx", "promo_redemptions (key)"),
+            ("promo_redemptions_redeemed_at_idx", "promo_redemptions (redeemed_at)"),
+            ("purchases_creator_purchased_at_idx", "purchases (creator_id, purchased_at)"),
+            ("promo_codes_creator_id_idx", "promo_codes (creator_id)"),
+        ],
+    },
+    {
+        "version": 4,
+        "name": "promo uses counter and unique redemptions",
+        "sql": [
+            "ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS uses INTEGER NOT NULL DEFAULT 0",
+            """
+            UPDATE promo_codes p SET uses = r.cnt
+            FROM (SELECT code, COUNT(*) AS cnt FROM promo_redemptions GROUP BY code) r
+            WHERE r.code = p.code
+            """,
+            # дубли, которые успели проскочить старую проверку, мешают уникальному индексу
+            """
+            DELETE FROM promo_redemptions r
+            USING promo_redemptions d
+            WHERE r.code = d.code AND r.key = d.key AND r.hwid = d.hwid AND r.id > d.id
+            """,
+        ],
+        "indexes": [
+            ("promo_redemptions_code_key_hwid_uniq", "promo_redemptions (code, key, hwid)", True),
+        ],
+        "drop_indexes": ["promo_redemptions_code_key_hwid_idx"],
+    },
+    {
+        "version": 5,
+        "name": "referral rollups",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS promo_code_stats (
+                code TEXT PRIMARY KEY,
+                redemptions BIGINT NOT NULL DEFAULT 0,
+                purchases BIGINT NOT NULL DEFAULT 0,
+                revenue NUMERIC(14,2) NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS creator_stats (
+                creator_id INTEGER PRIMARY KEY REFERENCES creators(id) ON DELETE CASCADE,
+                redemptions BIGINT NOT NULL DEFAULT 0,
+                purchases BIGINT NOT NULL DEFAULT 0,
+                revenue NUMERIC(14,2) NOT NULL DEFAULT 0
+            )
+            """,
+            # creator_id = 0 — применения/покупки без автора
+            """
+            CREATE TABLE IF NOT EXISTS referral_daily_stats (
+                day DATE NOT NULL,
+                creator_id INTEGER NOT NULL DEFAULT 0,
+                redemptions BIGINT NOT NULL DEFAULT 0,
+                purchases BIGINT NOT NULL DEFAULT 0,
+                revenue NUMERIC(14,2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, creator_id)
+            )
+            """,
+            # агрегаты заполняет пересчёт после миграций (rebuild_stats у миграции 9):
+            # REBUILD_REFERRAL_STATS_SQL читает колонки и таблицы, которых на этой версии схемы ещё нет
+        ],
+    },
+    {
+        "version": 6,
+        "name": "lease revocations",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS lease_revocations (
+                key TEXT PRIMARY KEY,
+                revoked_at TIMESTAMP NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS lease_revocations_revoked_at_idx ON lease_revocations (revoked_at)",
+        ],
+    },
+    {
+        "version": 7,
+        "name": "key last seen",
+        "sql": [
+            "ALTER TABLE keys ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP",
+            "ALTER TABLE keys ADD COLUMN IF NOT EXISTS client_version TEXT NOT NULL DEFAULT ''",
+        ],
+    },
+    {
+        # Логи становятся секционированными по месяцам (данные переносятся в этой же транзакции).
+        # Уникальность code+key+hwid не может быть глобальной на секциях — она переезжает
+        # в promo_redemption_keys, по нему же идут проверки антифрода в apply_promo_code.
+        "version": 8,
+        "name": "monthly partitions for promo_redemptions and purchases",
+        "sql": [
+            """
+            CREATE TABLE promo_redemption_keys (
+                key TEXT NOT NULL,
+                code TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                PRIMARY KEY (key, code, hwid)
+            )
+            """,
+            """
+            INSERT INTO promo_redemption_keys (key, code, hwid)
+            SELECT DISTINCT key, code, hwid FROM promo_redemptions
+            """,
+            REFERRAL_ARCHIVE_STATS_TABLE_SQL,
+
+            "ALTER TABLE promo_redemptions RENAME TO promo_redemptions_legacy",
+            "ALTER INDEX promo_redemptions_pkey RENAME TO promo_redemptions_legacy_pkey",
+            """
+            DROP INDEX IF EXISTS promo_redemptions_code_key_hwid_uniq, promo_redemptions_code_key_hwid_idx,
+                promo_redemptions_key_idx, promo_redemptions_redeemed_at_idx
+            """,
+            "ALTER SEQUENCE promo_redemptions_id_seq OWNED BY NONE",
+            """
+            CREATE TABLE promo_redemptions (
+                id INTEGER NOT NULL DEFAULT nextval('promo_redemptions_id_seq'),
+                code TEXT NOT NULL,
+                key TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                redeemed_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (id, redeemed_at)
+            ) PARTITION BY RANGE (redeemed_at)
+            """,
+            "ALTER SEQUENCE promo_redemptions_id_seq OWNED BY promo_redemptions.id",
+            "CREATE INDEX promo_redemptions_key_idx ON promo_redemptions (key)",
+            "CREATE INDEX promo_redemptions_redeemed_at_idx ON promo_redemptions (redeemed_at)",
+
+            "ALTER TABLE purchases RENAME TO purchases_legacy",
+            "ALTER INDEX purchases_pkey RENAME TO purchases_legacy_pkey",
+            "DROP INDEX IF EXISTS purchases_creator_purchased_at_idx",
+            "ALTER SEQUENCE purchases_id_seq OWNED BY NONE",
+            """
+            CREATE TABLE purchases (
+                id INTEGER NOT NULL DEFAULT nextval('purchases_id_seq'),
+                key TEXT NOT NULL,
+                amount NUMERIC(10,2) NOT NULL,
+                code TEXT,
+                creator_id INTEGER REFERENCES creators(id),
+                purchased_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (id, purchased_at)
+            ) PARTITION BY RANGE (purchased_at)
+            """,
+            "ALTER SEQUENCE purchases_id_seq OWNED BY purchases.id",
+            "CREATE INDEX purchases_creator_purchased_at_idx ON purchases (creator_id, purchased_at)",
+
+            # секции с месяца самой старой записи и на три месяца вперёд; дальше — командой partitions.
+            # Дата входит в первичный ключ (NOT NULL): старые строки без даты получают дату самой старой записи
+            """
+            DO $$
+            DECLARE
+                t RECORD;
+                m DATE;
+            BEGIN
+                FOR t IN SELECT * FROM (VALUES ('promo_redemptions', 'redeemed_at'),
+                                               ('purchases', 'purchased_at')) v(tbl, col) LOOP
+                    EXECUTE format('UPDATE %I SET %I = (SELECT COALESCE(MIN(%I), LOCALTIMESTAMP) FROM %I) WHERE %I IS NULL',
+                                   t.tbl || '_legacy', t.col, t.col, t.tbl || '_legacy', t.col);
+                    EXECUTE format('SELECT date_trunc(''month'', COALESCE(MIN(%I), LOCALTIMESTAMP))::date FROM %I',
+                                   t.col, t.tbl || '_legacy') INTO m;
+                    WHILE m < date_trunc('month', LOCALTIMESTAMP) + interval '4 months' LOOP
+                        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                                       t.tbl || to_char(m, '"_y"YYYY"m"MM'), t.tbl,
+                                       m, (m + interval '1 month')::date);
+                        m := (m + interval '1 month')::date;
+                    END LOOP;
+                    -- строки с датой вне созданных секций не теряются
+                    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', t.tbl || '_default', t.tbl);
+                END LOOP;
+            END
+            $$
+            """,
+            """
+            INSERT INTO promo_redemptions (id, code, key, hwid, redeemed_at)
+            SELECT id, code, key, hwid, redeemed_at FROM promo_redemptions_legacy
+            """,
+            """
+            INSERT INTO purchases (id, key, amount, code, creator_id, purchased_at)
+            SELECT id, key, amount, code, creator_id, purchased_at FROM purchases_legacy
+            """,
+            "DROP TABLE promo_redemptions_legacy, purchases_legacy",
+        ],
+    },
+    {
+        # Комиссия фиксируется в покупке по проценту автора на момент покупки
+        # и копится в агрегатах — отчёт по комиссиям не сканирует purchases.
+        "version": 9,
+        "name": "purchase commissions and idempotency keys",
+        "sql": [
+            "ALTER TABLE purchases ADD COLUMN IF NOT EXISTS commission NUMERIC(10,2) NOT NULL DEFAULT 0",
+            """
+            UPDATE purchases p SET commission = ROUND(p.amount * c.commission_percent / 100.0, 2)
+            FROM creators c WHERE c.id = p.creator_id AND c.commission_percent IS NOT NULL
+            """,
+            "ALTER TABLE creator_stats ADD COLUMN IF NOT EXISTS commission NUMERIC(14,2) NOT NULL DEFAULT 0",
+            "ALTER TABLE referral_daily_stats ADD COLUMN IF NOT EXISTS commission NUMERIC(14,2) NOT NULL DEFAULT 0",
+            "ALTER TABLE referral_archive_stats ADD COLUMN IF NOT EXISTS commission NUMERIC(14,2) NOT NULL DEFAULT 0",
+            # по архивным секциям остались только суммы — комиссия по текущему проценту автора
+            """
+            UPDATE referral_archive_stats a SET commission = ROUND(a.revenue * c.commission_percent / 100.0, 2)
+            FROM creators c WHERE c.id = a.creator_id AND c.commission_percent IS NOT NULL
+            """,
+            # purchase_id пустой, пока покупка пишется в той же транзакции
+            """
+            CREATE TABLE purchase_idempotency (
+                idempotency_key TEXT PRIMARY KEY,
+                purchase_id INTEGER,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            """,
+        ],
+        "rebuild_stats": True,
+    },
+    {
+        # swept_at — ключ выключен expiry sweeper'ом, а не админом (для клиента он «expired»).
+        # Частичный индекс содержит только активные ключи: выборка «истекают скоро» и сам проход
+        # не читают уже выключенные.
+        "version": 10,
+        "name": "expiry sweeper",
+        "sql": [
+            "ALTER TABLE keys ADD COLUMN IF NOT EXISTS swept_at TIMESTAMP",
+            """
+            CREATE TABLE IF NOT EXISTS key_events (
+                id BIGSERIAL PRIMARY KEY,
+                key TEXT NOT NULL,
+                event TEXT NOT NULL,
+                expires_at TIMESTAMP,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            """,
+        ],
+        "indexes": [
+            ("keys_active_expires_at_idx", "keys (expires_at, id) WHERE active"),
+            ("key_events_event_expires_at_idx", "key_events (event, expires_at, id)"),
+        ],
+    },
+    {
+        # функция нужна триггеру уже здесь; дальше её пересоздаёт SQL_FUNCTIONS
+        "version": 11,
+        "name": "notify inserted keys",
+        "sql": [
+            NOTIFY_KEYS_INSERTED_SQL,
+            """
+            CREATE TRIGGER keys_notify_inserted AFTER INSERT ON keys
+            REFERENCING NEW TABLE AS inserted_keys
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_keys_inserted()
+            """,
+        ],
+    },
+]
+
+def create_index_concurrently(conn, name, definition, unique=False):
+    # упавший CREATE INDEX CONCURRENTLY оставляет невалидный индекс — пересоздаём его
+    row = conn.execute("""
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid)
+    """, (name,)).fetchone()
+    if row is not None and not row["indisvalid"]:
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    unique = "UNIQUE " if unique else ""
+    conn.execute(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+def record_migration(conn, m):
+    conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (m["version"], m["name"]))
+
+def migrate(log=print):
+    # отдельное autocommit-соединение: CONCURRENTLY нельзя выполнять в транзакции
+    with psycopg.connect(DATABASE_URL, autocommit=True, row_factory=dict_row) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        # параллельные деплои ждут друг друга
+        conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            applied = {row["version"] for row in conn.execute("SELECT version FROM schema_migrations")}
+            rebuild_stats = False
+            for m in MIGRATIONS:
+                if m["version"] in applied:
+                    continue
+                log(f"migration {m['version']}: {m['name']}")
+                concurrent = m.get("indexes") or m.get("drop_indexes")
+                with conn.transaction():
+                    for statement in m.get("sql", []):
+                        conn.execute(statement)
+                    if not concurrent:
+                        record_migration(conn, m)
+                for index in m.get("indexes", []):
+                    create_index_concurrently(conn, *index)
+                for name in m.get("drop_indexes", []):
+                    conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                if concurrent:
+                    record_migration(conn, m)
+                rebuild_stats = rebuild_stats or m.get("rebuild_stats", False)
+            with conn.transaction():
+                for statement in SQL_FUNCTIONS:
+                    conn.execute(statement)
+            if rebuild_stats:
+                log("rebuilding referral stats")
+                with conn.transaction():
+                    for statement in REBUILD_REFERRAL_STATS_SQL:
+                        conn.execute(statement)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+def schema_version():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+            return cur.fetchone()["version"]
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Применить недостающие миграции схемы."""
+    migrate()
+    print(f"schema version: {schema_version()}")
+
+@app.cli.command("generate-keys")
+@click.option("--count", type=int, required=True)
+@click.option("--days", type=int, default=30, show_default=True)
+@click.option("--owner", default="")
+@click.option("--out", type=click.File("w"), default="-", help="CSV с созданными ключами")
+def generate_keys_command(count, days, owner, out):
+    """Массово создать ключи (COPY в одной транзакции)."""
+    keys, expires_at = generate_keys(count, days, owner)
+    writer = csv.writer(out)
+    writer.writerow(["key", "expires_at", "owner"])
+    expires = expires_at.strftime("%Y-%m-%d %H:%M:%S")
+    for key in keys:
+        writer.writerow([key, expires, owner])
+    click.echo(f"created {len(keys)} keys", err=True)
+
+@app.cli.command("import-keys")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--days", type=int, default=30, show_default=True)
+@click.option("--owner", default="")
+def import_keys_command(path, days, owner):
+    """Импортировать ключи из CSV: key[,expires_at][,owner][,hwid]."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        report = import_keys(f, days, owner)
+    click.echo(f"inserted: {report['inserted']}")
+    click.echo(f"duplicates: {len(report['duplicates'])}")
+    for key in report["duplicates"]:
+        click.echo(f"  {key}")
+    if report["invalid_lines"]:
+        click.echo(f"invalid lines: {', '.join(map(str, report['invalid_lines']))}")
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Пересчитать агрегаты /referrals из promo_redemptions и purchases."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            for statement in REBUILD_REFERRAL_STATS_SQL:
+                cur.execute(statement)
+    print("referral stats rebuilt")
+
+# ---------------- Секции логов ----------------
+PARTITIONED_LOGS = {"promo_redemptions": "redeemed_at", "purchases": "purchased_at"}
+PARTITION_LOCK_ID = 72010002
+
+# агрегаты секции перед выгрузкой: после удаления она больше не видна rebuild-stats
+ARCHIVE_STATS_SQL = {
+    "promo_redemptions": """
+        INSERT INTO referral_archive_stats (day, code, creator_id, redemptions)
+        SELECT r.redeemed_at::date, r.code, COALESCE(p.creator_id, 0), COUNT(*)
+        FROM {name} r LEFT JOIN promo_codes p ON p.code = r.code
+        GROUP BY 1, 2, 3
+    """,
+    "purchases": """
+        INSERT INTO referral_archive_stats (day, code, creator_id, purchases, revenue, commission)
+        SELECT purchased_at::date, COALESCE(code, ''), COALESCE(creator_id, 0), COUNT(*), SUM(amount),
+               SUM(commission)
+        FROM {name}
+        GROUP BY 1, 2, 3
+    """,
+}
+
+def add_months(month, n):
+    year, index = divmod(month.month - 1 + n, 12)
+    return date(month.year + year, index + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+def list_partitions(conn, table):
+    # {первое число месяца: имя} присоединённых помесячных секций
+    rows = conn.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,)).fetchall()
+    partitions = {}
+    for row in rows:
+        m = re.fullmatch(rf"{table}_y(\d{{4}})m(\d{{2}})", row["relname"])
+        if m:
+            partitions[date(int(m[1]), int(m[2]), 1)] = row["relname"]
+    return partitions
+
+def create_partition(conn, table, month):
+    column = PARTITIONED_LOGS[table]
+    name = partition_name(table, month)
+    start, end = month, add_months(month, 1)
+    with conn.transaction():
+        conn.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+        # строки этого месяца, успевшие лечь в секцию по умолчанию, иначе ATTACH не пройдёт
+        moved = conn.execute(f"""
+            WITH moved AS (
+                DELETE FROM {table}_default WHERE {column} >= %s AND {column} < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, (start, end)).rowcount
+        conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    return name, moved
+
+def archive_partition(conn, table, name, archive_dir):
+    # выгрузка в csv.gz и удаление; без archive_dir секция только отсоединяется
+    with conn.transaction():
+        conn.execute(f"LOCK TABLE {name} IN SHARE MODE")
+        path = None
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+            path = os.path.join(archive_dir, f"{name}.csv.gz")
+            with open(path + ".tmp", "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                    with conn.cursor().copy(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)") as copy:
+                        for chunk in copy:
+                            f.write(chunk)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(path + ".tmp", path)
+        conn.execute(ARCHIVE_STATS_SQL[table].format(name=name))
+        conn.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        if archive_dir:
+            conn.execute(f"DROP TABLE {name}")
+    return path
+
+def maintain_partitions(ahead, archive_after=0, archive_dir="", since=None, log=print):
+    # since — первый месяц, с которого секции должны существовать (по умолчанию текущий)
+    today = date.today().replace(day=1)
+    first = (since or today).replace(day=1)
+    if archive_after > 0:
+        # секции, которые сразу ушли бы в архив, не создаём
+        first = max(first, add_months(today, -archive_after))
+    with psycopg.connect(DATABASE_URL, autocommit=True, row_factory=dict_row) as conn:
+        if not conn.execute("SELECT pg_try_advisory_lock(%s) AS ok", (PARTITION_LOCK_ID,)).fetchone()["ok"]:
+            log("partition maintenance is already running")
+            return
+        try:
+            for table in PARTITIONED_LOGS:
+                existing = list_partitions(conn, table)
+                month = first
+                while month <= add_months(today, ahead):
+                    if month not in existing:
+                        name, moved = create_partition(conn, table, month)
+                        log(f"{name}: created" + (f", moved {moved} rows from default" if moved else ""))
+                    month = add_months(month, 1)
+
+                if archive_after > 0:
+                    cutoff = add_months(today, -archive_after)
+                    for month, name in sorted(list_partitions(conn, table).items()):
+                        if month < cutoff:
+                            path = archive_partition(conn, table, name, archive_dir)
+                            log(f"{name}: " + (f"archived to {path}" if path else "detached"))
+
+                left = conn.execute(f"SELECT COUNT(*) AS cnt FROM {table}_default").fetchone()["cnt"]
+                if left:
+                    log(f"warning: {left} rows in {table}_default (dates outside monthly partitions)")
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (PARTITION_LOCK_ID,))
+
+@app.cli.command("partitions")
+@click.option("--ahead", type=int, default=PARTITION_MONTHS_AHEAD, show_default=True,
+              help="на сколько месяцев вперёд создавать секции")
+@click.option("--archive-after", type=int, default=PARTITION_ARCHIVE_AFTER, show_default=True,
+              help="выгружать секции старше N месяцев (0 — не трогать)")
+@click.option("--archive-dir", type=click.Path(file_okay=False), default=PARTITION_ARCHIVE_DIR,
+              help="каталог для csv.gz; без него старые секции только отсоединяются")
+@click.option("--since", type=click.DateTime(["%Y-%m"]), default=None,
+              help="создать недостающие секции начиная с месяца YYYY-MM")
+def partitions_command(ahead, archive_after, archive_dir, since):
+    """Обслужить помесячные секции promo_redemptions и purchases (запускать по cron)."""
+    maintain_partitions(ahead, archive_after, archive_dir, since.date() if since else None, log=click.echo)
+
+# ---------------- Истёкшие ключи ----------------
+EXPIRY_SWEEP_LOCK_ID = 72010003
+
+# Пачка истёкших активных ключей (по частичному индексу) выключается и пишется в key_events.
+# SKIP LOCKED: строки, занятые check_key/apply_promo/админкой, заберёт следующий проход.
+EXPIRY_SWEEP_SQL = """
+    WITH expired AS (
+        SELECT id FROM keys
+        WHERE active AND expires_at <= LOCALTIMESTAMP
+        ORDER BY expires_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), swept AS (
+        UPDATE keys k SET active = FALSE, swept_at = LOCALTIMESTAMP
+        FROM expired e WHERE k.id = e.id
+        RETURNING k.key, k.expires_at
+    )
+    INSERT INTO key_events (key, event, expires_at)
+    SELECT key, 'expired', expires_at FROM swept
+"""
+
+class ExpirySweeper:
+    # Фоновый поток в каждом процессе, но проход в каждый момент один: кто не взял advisory lock,
+    # пропускает круг. Кэш ключей не трогаем — истёкшие строки check_key и так перечитывает из БД.
+    def __init__(self, interval, batch):
+        self.interval = interval
+        self.batch = batch
+        self.runs = 0
+        self.swept = 0
+        self.last_run = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not EXPIRY_SWEEP_ENABLED or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="expiry-sweeper", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except psycopg.Error:
+                app.logger.exception("expiry sweeper failed")
+            time.sleep(self.interval)
+
+    def sweep(self):
+        # -> сколько ключей выключено; None — проход уже идёт в другом процессе
+        swept = 0
+        with psycopg.connect(DATABASE_URL, autocommit=True, row_factory=dict_row) as conn:
+            if not conn.execute("SELECT pg_try_advisory_lock(%s) AS ok", (EXPIRY_SWEEP_LOCK_ID,)).fetchone()["ok"]:
+                return None
+            try:
+                while True:
+                    # каждая пачка — своя короткая транзакция
+                    count = conn.execute(EXPIRY_SWEEP_SQL, (self.batch,)).rowcount
+                    swept += count
+                    if count < self.batch:
+                        break
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(%s)", (EXPIRY_SWEEP_LOCK_ID,))
+        self.runs += 1
+        self.swept += swept
+        self.last_run = datetime.now()
+        return swept
+
+    def stats(self):
+        return {
+            "enabled": EXPIRY_SWEEP_ENABLED,
+            "runs": self.runs,
+            "swept": self.swept,
+            "last_run": self.last_run.strftime("%Y-%m-%d %H:%M:%S") if self.last_run else None,
+        }
+
+expiry_sweeper = ExpirySweeper(EXPIRY_SWEEP_INTERVAL, EXPIRY_SWEEP_BATCH)
+
+@app.before_request
+def start_expiry_sweeper():
+    expiry_sweeper.start()
+
+@app.cli.command("sweep-expired")
+def sweep_expired_command():
+    """Выключить истёкшие ключи (то же, что делает фоновый проход)."""
+    swept = expiry_sweeper.sweep()
+    click.echo("sweep is already running" if swept is None else f"swept {swept} keys")
+
+class TTLCache:
+    # LRU + TTL, потокобезопасный; значения живут не дольше ttl секунд
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires = item
+            if expires <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# owner/active/expires_at/hwid по ключу; кладём только уже привязанные ключи,
+# любое изменение строки ключа обязано вызвать key_cache.invalidate(key)
+key_cache = TTLCache(KEY_CACHE_SIZE, KEY_CACHE_TTL)
+
+def key_check_result(key, row, hwid, now=None):
+    now = now or datetime.now()
+    if not row["active"] and not row["swept_at"]:
+        return {"status": "invalid", "reason": "inactive"}
+    # выключенный expiry sweeper'ом ключ по-прежнему отвечает «expired»
+    if not row["active"] or row["expires_at"] <= now:
+        return {"status": "invalid", "reason": "expired"}
+    if row["hwid"] and row["hwid"] != hwid:
+        return {"status": "invalid", "reason": "hwid_mismatch"}
+
+    # время до окончания
+    delta = row["expires_at"] - now
+    return {
+        "status": "ok",
+        "key": key,
+        "owner": row["owner"],
+        "active": True,
+        "hwid": row["hwid"] or hwid,
+        "expires_at": row["expires_at"].strftime("%Y-%m-%d %H:%M:%S"),
+        "days_left": delta.days,
+        "hours_left": delta.seconds // 3600
+    }
+
+# ---------------- Офлайн-лизы ----------------
+# Лиза — подписанный Ed25519 токен base64url(payload).base64url(signature):
+# клиент проверяет его публичным ключом (/lease/public_key) и ходит к серверу только за продлением.
+# Отзыв (deactivate/delete/reset_hwid) пишется в lease_revocations; воркеры держат
+# в памяти отзывы за последние LEASE_TTL секунд и обновляют их раз в LEASE_REVOCATION_REFRESH.
+_lease_signer = (
+    Ed25519PrivateKey.from_private_bytes(base64.b64decode(LEASE_PRIVATE_KEY))
+    if LEASE_PRIVATE_KEY else None
+)
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64url_decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def lease_public_key():
+    return b64url(_lease_signer.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+def issue_lease(key, hwid, expires_at, now=None):
+    now = now or datetime.now()
+    lease_expires_at = min(now + timedelta(seconds=LEASE_TTL), expires_at)
+    payload = json.dumps({
+        "key": key,
+        "hwid": hwid,
+        "expires_at": expires_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "iat": int(now.timestamp()),
+        "lease_exp": int(lease_expires_at.timestamp()),
+    }, separators=(",", ":"), sort_keys=True).encode()
+    return b64url(payload) + "." + b64url(_lease_signer.sign(payload))
+
+def read_lease(token):
+    # payload подписанной лизы или None
+    try:
+        payload, signature = token.split(".")
+        payload = b64url_decode(payload)
+        _lease_signer.public_key().verify(b64url_decode(signature), payload)
+        return json.loads(payload)
+    except (ValueError, AttributeError, InvalidSignature):
+        return None
+
+class RevocationList:
+    def __init__(self):
+        self._revoked = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        if time.monotonic() - self._loaded_at < LEASE_REVOCATION_REFRESH:
+            return
+        # обновляет один поток, остальные пока работают со старым списком
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            since = datetime.now() - timedelta(seconds=LEASE_TTL)
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT key, revoked_at FROM lease_revocations WHERE revoked_at > %s",
+                        (since,)
+                    )
+                    self._revoked = {row["key"]: row["revoked_at"].timestamp() for row in cur.fetchall()}
+            self._loaded_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def add(self, key, revoked_at):
+        self._revoked[key] = revoked_at.timestamp()
+
+    def is_revoked(self, key, issued_at):
+        revoked_at = self._revoked.get(key)
+        return revoked_at is not None and revoked_at >= issued_at
+
+    def __len__(self):
+        return len(self._revoked)
+
+lease_revocations = RevocationList()
+
+def revoke_leases(cur, key):
+    # вызывать в транзакции изменения ключа
+    now = datetime.now()
+    cur.execute("""
+        INSERT INTO lease_revocations (key, revoked_at) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET revoked_at = EXCLUDED.revoked_at
+    """, (key, now))
+    lease_revocations.add(key, now)
+
+def renew_lease(token, hwid, now=None):
+    # подпись, hwid, срок и список отзыва; срок ключа берём из keys — его мог продлить промокод
+    now = now or datetime.now()
+    lease = read_lease(token or "")
+    if lease is None:
+        return {"status": "invalid", "reason": "lease_invalid"}
+    if lease["hwid"] != hwid:
+        return {"status": "invalid", "reason": "hwid_mismatch"}
+    if lease["lease_exp"] <= now.timestamp():
+        return {"status": "invalid", "reason": "lease_expired"}
+    lease_revocations.refresh()
+    if lease_revocations.is_revoked(lease["key"], lease["iat"]):
+        return {"status": "invalid", "reason": "lease_revoked"}
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(KEY_LOOKUP_SQL, (lease["key"],))
+            row = cur.fetchone()
+    if not row:
+        return {"status": "invalid", "reason": "not_found"}
+    result = key_check_result(lease["key"], row, hwid, now)
+    if result["status"] != "ok":
+        return result
+    return {"status": "ok", "lease": issue_lease(lease["key"], hwid, row["expires_at"], now)}
+
+def with_lease(result, data, now=None):
+    # лиза выдаётся по запросу клиента ("lease": true) и только для успешной проверки
+    if data.get("lease") and _lease_signer is not None and result["status"] == "ok":
+        expires_at = datetime.strptime(result["expires_at"], "%Y-%m-%d %H:%M:%S")
+        result = dict(result, lease=issue_lease(result["key"], result["hwid"], expires_at, now))
+    return result
+
+KEY_LOOKUP_SQL = "SELECT owner, active, expires_at, hwid, swept_at FROM keys WHERE key=%s"
+KEYS_LOOKUP_SQL = "SELECT key, owner, active, expires_at, hwid, swept_at FROM keys WHERE key = ANY(%s)"
+# привязываем только ещё не привязанные ключи (hwid '' или NULL): параллельный запрос не перезатрётся
+KEYS_BIND_SQL = """
+    UPDATE keys AS k SET hwid = b.hwid
+    FROM unnest(%s::text[], %s::text[]) AS b(key, hwid)
+    WHERE k.key = b.key AND COALESCE(k.hwid, '') = ''
+    RETURNING k.key, k.hwid
+"""
+KEYS_HWID_SQL = "SELECT key, hwid FROM keys WHERE key = ANY(%s)"
+# last_seen пишется «по возможности»: строки, занятые другой транзакцией, пропускаем
+# (придут со следующим heartbeat), а время назад не откатываем
+KEYS_TOUCH_SQL = """
+    UPDATE keys AS k SET last_seen_at = t.seen_at, client_version = t.version
+    FROM unnest(%s::text[], %s::timestamp[], %s::text[]) AS t(key, seen_at, version)
+    WHERE k.key = t.key
+      AND k.id IN (SELECT id FROM keys WHERE key = ANY(%s) FOR NO KEY UPDATE SKIP LOCKED)
+      AND (k.last_seen_at IS NULL OR k.last_seen_at < t.seen_at)
+"""
+
+class _PendingBind:
+    def __init__(self, binds):
+        self.binds = binds
+        self.saved = None
+        self.error = None
+        self.done = threading.Event()
+
+class KeyWriter:
+    # Очередь отложенной записи воркера. touch() не ждёт ничего, повторные отметки
+    # одного ключа схлопываются. bind() ждёт общего UPDATE ... WHERE hwid = '' и возвращает
+    # hwid, который реально сохранён: из двух машин ключ достаётся только одной.
+    # Поток записи свой в каждом процессе (после fork очередь родителя не наследуется).
+    def __init__(self, batch_size, interval, bind_wait):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.bind_wait = bind_wait
+        self._cond = threading.Condition()
+        self._touches = {}
+        self._binds = []
+        self._bind_keys = 0
+        self._binds_since = None
+        self._flushed_at = time.monotonic()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self.flushes = 0
+        self.errors = 0
+
+    def _ensure_thread(self):
+        # вызывается под self._cond
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._touches, self._binds, self._bind_keys, self._binds_since = {}, [], 0, None
+        self._stopping = False
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="key-writer", daemon=True)
+        self._thread.start()
+
+    def touch(self, key, version, now):
+        with self._cond:
+            self._ensure_thread()
+            # на пустой очереди поток ждёт без таймаута — будим, чтобы он завёл таймер interval
+            wake = not self._touches
+            self._touches[key] = (now, version)
+            if wake or len(self._touches) >= self.batch_size:
+                self._cond.notify()
+
+    def bind(self, binds):
+        # binds: {key: hwid}; возвращает {key: сохранённый hwid}
+        pending = _PendingBind(binds)
+        with self._cond:
+            self._ensure_thread()
+            self._binds.append(pending)
+            self._bind_keys += len(binds)
+            if self._binds_since is None:
+                self._binds_since = time.monotonic()
+            self._cond.notify()
+        if not pending.done.wait(DB_POOL_TIMEOUT + self.bind_wait + 5):
+            raise TimeoutError("key writer did not flush in time")
+        if pending.error is not None:
+            raise pending.error
+        return pending.saved
+
+    def _wait_time(self):
+        # None — ждать без таймаута, 0 — пора писать
+        now = time.monotonic()
+        if self._stopping or len(self._touches) >= self.batch_size or self._bind_keys >= self.batch_size:
+            return 0
+        waits = []
+        if self._binds:
+            waits.append(self._binds_since + self.bind_wait - now)
+        if self._touches:
+            waits.append(self._flushed_at + self.interval - now)
+        return max(min(waits), 0) if waits else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._wait_time()
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+                touches, binds = self._touches, self._binds
+                self._touches, self._binds, self._bind_keys, self._binds_since = {}, [], 0, None
+                if touches or not binds:
+                    self._flushed_at = time.monotonic()
+                stopping = self._stopping
+            self._flush(touches, binds)
+            if stopping:
+                return
+
+    def _flush(self, touches, binds):
+        if binds:
+            self._flush_binds(binds)
+        if touches:
+            started = time.perf_counter()
+            keys = sorted(touches)
+            try:
+                with get_conn() as conn:
+                    conn.execute(KEYS_TOUCH_SQL, (
+                        keys, [touches[k][0] for k in keys], [touches[k][1] for k in keys], keys
+                    ))
+                self.flushes += 1
+            except psycopg.Error:
+                # отметки последнего визита не критичны: теряем пачку, но не воркер
+                self.errors += 1
+                app.logger.exception("key writer: last_seen flush failed (%d keys)", len(keys))
+            KEY_WRITER_FLUSH_LATENCY.labels("touch").observe(time.perf_counter() - started)
+            KEY_WRITER_BATCH_SIZE.labels("touch").observe(len(keys))
+
+    def _flush_binds(self, binds):
+        started = time.perf_counter()
+        # внутри пачки ключ достаётся первому запросу
+        wanted = {}
+        for pending in binds:
+            for key, hwid in pending.binds.items():
+                wanted.setdefault(key, hwid)
+        keys = sorted(wanted)
+        try:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(KEYS_BIND_SQL, (keys, [wanted[k] for k in keys]))
+                    saved = {row["key"]: row["hwid"] for row in cur.fetchall()}
+                    lost = [key for key in keys if key not in saved]
+                    if lost:
+                        # ключ успел привязать другой воркер
+                        cur.execute(KEYS_HWID_SQL, (lost,))
+                        saved.update({row["key"]: row["hwid"] for row in cur.fetchall()})
+            self.flushes += 1
+        except Exception as e:
+            self.errors += 1
+            for pending in binds:
+                pending.error = e
+                pending.done.set()
+            return
+        finally:
+            KEY_WRITER_FLUSH_LATENCY.labels("bind").observe(time.perf_counter() - started)
+            KEY_WRITER_BATCH_SIZE.labels("bind").observe(len(keys))
+        for key in keys:
+            key_cache.invalidate(key)
+        for pending in binds:
+            pending.saved = {key: saved.get(key) for key in pending.binds}
+            pending.done.set()
+
+    def stop(self, timeout=10):
+        # дописывает очередь; вызывается при выходе процесса
+        with self._cond:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify()
+        thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued_touches": len(self._touches),
+                "queued_binds": self._bind_keys,
+                "flushes": self.flushes,
+                "errors": self.errors,
+            }
+
+key_writer = KeyWriter(WRITE_BEHIND_BATCH, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BIND_WAIT)
+atexit.register(key_writer.stop)
+
+def client_version(data):
+    version = data.get("version") or data.get("client_version") or ""
+    return version.strip()[:64] if isinstance(version, str) else ""
+
+# ---------------- Защита от перебора ключей ----------------
+class KeyFilter:
+    # Bloom-фильтр по keys.key. Ложноположительные ответы идут в БД как обычно, ложноотрицательных нет.
+    # Любая вставка в keys (триггер keys_notify_inserted) в той же транзакции шлёт
+    # "keys:<первый id>:<последний id>", слушатель CHANGES_CHANNEL дочитывает эти ключи.
+    # Поэтому «ключа точно нет» фильтр отвечает,
+    # только пока слушатель подключён и загрузка начата уже после подключения: иначе часть
+    # оповещений могла пройти мимо. Удаление ключа фильтр не видит до перестройки — это лишь
+    # лишний поход в БД.
+    def __init__(self, fp_rate, rebuild):
+        self.fp_rate = fp_rate
+        self.rebuild_interval = rebuild
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._filter = None  # (bits, size, hashes, capacity)
+        self._count = 0
+        self._pending = []  # ключи из оповещений, пришедших во время загрузки
+        self._pid = os.getpid()
+        self._loaded_since = 0.0
+        self._listening_since = None
+        self._built_at = 0.0
+        self._building = False
+        self.rejected = 0
+
+    @staticmethod
+    def _positions(key, size, hashes):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % size for i in range(hashes)]
+
+    def _new_filter(self, count):
+        # запас в два раза под новые ключи до следующей перестройки
+        capacity = max(count * 2, 10000)
+        size = int(-capacity * math.log(self.fp_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return bytearray(size // 8 + 1), size, hashes, capacity
+
+    @classmethod
+    def _set(cls, flt, key):
+        bits, size, hashes, _ = flt
+        for p in cls._positions(key, size, hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    @classmethod
+    def _test(cls, flt, key):
+        bits, size, hashes, _ = flt
+        return all(bits[p >> 3] >> (p & 7) & 1 for p in cls._positions(key, size, hashes))
+
+    def listener_connected(self):
+        # вызывается потоком слушателя сразу после LISTEN
+        if self._pid != os.getpid():
+            self._reset()
+        self._listening_since = time.monotonic()
+
+    def listener_lost(self):
+        self._listening_since = None
+
+    def _trusted(self):
+        since = self._listening_since
+        return self._filter is not None and since is not None and self._loaded_since >= since
+
+    def _ensure_loaded(self):
+        if self._pid != os.getpid():
+            self._reset()
+        since = self._listening_since
+        if since is None:
+            # без слушателя загрузка всё равно не даст права отвечать «нет»
+            return
+        due = self._filter is None or self._loaded_since < since \
+            or time.monotonic() - self._built_at >= self.rebuild_interval or self._count > self._filter[3]
+        if due and not self._building:
+            with self._lock:
+                if self._building:
+                    return
+                self._building = True
+                self._pending = []
+            threading.Thread(target=self._build, name="key-filter", daemon=True).start()
+
+    def _build(self):
+        try:
+            loaded_since = time.monotonic()
+            with get_conn() as conn:
+                flt = self._new_filter(conn.execute("SELECT COUNT(*) AS cnt FROM keys").fetchone()["cnt"])
+                count = 0
+                with conn.cursor(name="key_filter") as cur:
+                    cur.itersize = EXPORT_FETCH_SIZE
+                    cur.execute("SELECT key FROM keys")
+                    for r in cur:
+                        self._set(flt, r["key"])
+                        count += 1
+            with self._lock:
+                for key in self._pending:
+                    self._set(flt, key)
+                self._filter, self._count, self._pending = flt, count, []
+                self._loaded_since = loaded_since
+                self._built_at = time.monotonic()
+        except psycopg.Error:
+            app.logger.exception("key filter: build failed")
+        finally:
+            self._building = False
+
+    def add(self, key):
+        # ключ создан в этом процессе: виден сразу, не дожидаясь своего же оповещения
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._filter is not None:
+                self._set(self._filter, key)
+            if self._building:
+                self._pending.append(key)
+
+    def add_range(self, first_id, last_id):
+        # оповещение "keys:<первый id>:<последний id>": ключи уже зафиксированы
+        if not KEY_FILTER_ENABLED:
+            return
+        with get_conn() as conn:
+            rows = conn.execute(
+                "SELECT key FROM keys WHERE id BETWEEN %s AND %s", (first_id, last_id)
+            ).fetchall()
+        for r in rows:
+            self.add(r["key"])
+        self._count += len(rows)
+
+    def maybe_contains(self, key):
+        if not KEY_FILTER_ENABLED:
+            return True
+        self._ensure_loaded()
+        return not self._trusted() or self._test(self._filter, key)
+
+    def check(self, key):
+        # False — ключа точно нет
+        if self.maybe_contains(key):
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        flt = self._filter
+        return {
+            "enabled": KEY_FILTER_ENABLED,
+            "loaded": flt is not None,
+            "trusted": self._trusted(),
+            "keys": self._count,
+            "capacity": flt[3] if flt else 0,
+            "bits": flt[1] if flt else 0,
+            "hashes": flt[2] if flt else 0,
+            "rejected": self.rejected,
+        }
+
+key_filter = KeyFilter(KEY_FILTER_FP_RATE, KEY_FILTER_REBUILD)
+
+class RateLimiter:
+    # token bucket на клиента; хранится не больше maxsize вёдер, давно не приходившие
+    # вытесняются (LRU) и при возвращении начинают с полного запаса
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def allow(self, client, cost=1):
+        if not self.rate or not client:
+            return True
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            else:
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def stats(self):
+        return {"clients": len(self._buckets), "limited": self.limited}
+
+ip_limiter = RateLimiter(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, RATE_LIMIT_MAX_CLIENTS)
+hwid_limiter = RateLimiter(RATE_LIMIT_HWID_RATE, RATE_LIMIT_HWID_BURST, RATE_LIMIT_MAX_CLIENTS)
+RATE_LIMITED_RESPONSE = {"status": "invalid", "reason": "rate_limited"}
+
+def client_ip(remote_addr, headers):
+    if TRUST_PROXY_HEADERS:
+        # адрес, который дописал ближайший к нам прокси
+        forwarded = headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.split(",")[-1].strip()
+        return headers.get("X-Real-IP") or remote_addr
+    return remote_addr
+
+def throttled(ip, hwid="", cost=1):
+    return not ip_limiter.allow(ip, cost) or not hwid_limiter.allow(hwid)
+
+def cacheable_key(row, now):
+    return bool(row["hwid"]) and row["active"] and row["expires_at"] > now
+
+def parse_key_pairs(data):
+    # тело /check_keys: {"keys": [{"key", "hwid"}, ...]} или просто список;
+    # None — некорректный запрос
+    items = data.get("keys") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return None
+    pairs = []
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        pairs.append((
+            (item.get("key") or "").strip().upper(),
+            (item.get("hwid") or "").strip(),
+        ))
+    return pairs
+
+def cached_key_rows(pairs, now):
+    rows = {}
+    for key, hwid in pairs:
+        if key and hwid and key not in rows:
+            row = key_cache.get(key)
+            if row is not None and row["active"] and row["expires_at"] > now:
+                rows[key] = row
+    missing = list({key for key, hwid in pairs if key and hwid and key not in rows})
+    return rows, missing
+
+def pending_binds(pairs, rows, now):
+    # первая привязка: внутри пачки ключ достаётся первому hwid
+    binds = {}
+    for key, hwid in pairs:
+        row = rows.get(key)
+        if row and hwid and not row["hwid"] and key not in binds \
+                and key_check_result(key, row, hwid, now)["status"] == "ok":
+            binds[key] = hwid
+    return binds
+
+def apply_bind(rows, key, saved_hwid):
+    # None: ключ удалили между чтением и привязкой — отвечаем not_found
+    if saved_hwid is None:
+        rows.pop(key, None)
+    else:
+        rows[key] = dict(rows[key], hwid=saved_hwid)
+
+def batch_results(pairs, rows, now):
+    results = []
+    for key, hwid in pairs:
+        if not key or not hwid:
+            results.append({"status": "invalid", "reason": "missing_data"})
+        elif key not in rows:
+            results.append({"status": "invalid", "reason": "not_found"})
+        else:
+            results.append(key_check_result(key, rows[key], hwid, now))
+    return results
+
+def like_prefix(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def parse_date(value):
+    try:
+        return datetime.strptime((value or "").strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+
+def key_filters(args):
+    where, params = [], []
+    prefix = (args.get("q") or "").strip().upper()
+    if prefix:
+        where.append("key LIKE %s")
+        params.append(like_prefix(prefix))
+    owner = (args.get("owner") or "").strip().lower()
+    if owner:
+        where.append("lower(owner) LIKE %s")
+        params.append(like_prefix(owner))
+    hwid = (args.get("hwid") or "").strip()
+    if hwid:
+        where.append("hwid = %s")
+        params.append(hwid)
+    active = args.get("active")
+    if active in ("0", "1"):
+        where.append("active = %s")
+        params.append(active == "1")
+    expires_from = parse_date(args.get("expires_from"))
+    if expires_from:
+        where.append("expires_at >= %s")
+        params.append(expires_from)
+    expires_to = parse_date(args.get("expires_to"))
+    if expires_to:
+        # включительно: до конца указанного дня
+        where.append("expires_at < %s")
+        params.append(expires_to + timedelta(days=1))
+    return where, params
+
+def list_keys(args, limit):
+    # keyset-пагинация по id: курсор — id последней строки предыдущей страницы
+    where, params = key_filters(args)
+    before = args.get("before", type=int)
+    if before:
+        where.append("id < %s")
+        params.append(before)
+    sql = "SELECT id, key, owner, expires_at, active, hwid FROM keys"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT %s"
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params + [limit + 1])
+            rows = cur.fetchall()
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return rows[:limit], next_cursor
 
 def generate_short_key(length=12):
     chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+    return ''.join(secrets.choice(chars) for _ in range(length))
+
+def copy_keys(cur, rows):
+    # rows: (key, expires_at, owner, hwid), ключи без повторов. COPY во временную таблицу,
+    # затем один INSERT; уже существующие ключи пропускаются, а не валят транзакцию.
+    # Возвращает множество реально вставленных ключей.
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS keys_import (
+            key TEXT, expires_at TIMESTAMP, owner TEXT, hwid TEXT
+        ) ON COMMIT DROP
+    """)
+    cur.execute("TRUNCATE keys_import")
+    with cur.copy("COPY keys_import (key, expires_at, owner, hwid) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+    cur.execute("""
+        INSERT INTO keys (key, expires_at, owner, active, hwid)
+        SELECT key, expires_at, owner, TRUE, hwid
+        FROM keys_import
+        ON CONFLICT (key) DO NOTHING
+        RETURNING key
+    """)
+    created = {row["key"] for row in cur.fetchall()}
+    for key in created:
+        key_filter.add(key)
+    return created
+
+def generate_keys(count, days, owner=""):
+    expires_at = datetime.now() + timedelta(days=days)
+    created = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # коллизии с уже существующими ключами добираем новыми в той же транзакции
+            while len(created) < count:
+                batch = set()
+                while len(batch) < count - len(created):
+                    batch.add(generate_short_key())
+                created.extend(copy_keys(cur, [(k, expires_at, owner, "") for k in batch]))
+            conn.commit()
+    return created, expires_at
+
+def parse_import_expires(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+def import_keys(lines, days=30, owner=""):
+    # CSV: key[,expires_at][,owner][,hwid], заголовок необязателен;
+    # пустой expires_at — сейчас + days, пустой owner — owner по умолчанию
+    default_expires = datetime.now() + timedelta(days=days)
+    rows, invalid, repeated, seen = [], [], set(), set()
+    for line_no, record in enumerate(csv.reader(lines), start=1):
+        if not record or not any(cell.strip() for cell in record):
+            continue
+        if line_no == 1 and record[0].strip().lower() == "key":
+            continue
+        record = [cell.strip() for cell in record] + ["", "", ""]
+        key = record[0].upper()
+        expires_at = parse_import_expires(record[1]) if record[1] else default_expires
+        if not key or expires_at is None:
+            invalid.append(line_no)
+            continue
+        if key in seen:
+            # повтор внутри файла: остаётся первая строка
+            repeated.add(key)
+            continue
+        seen.add(key)
+        rows.append((key, expires_at, record[2] or owner, record[3]))
+
+    inserted = set()
+    if rows:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                inserted = copy_keys(cur, rows)
+                conn.commit()
+    duplicates = sorted({key for key, *_ in rows if key not in inserted} | repeated)
+    return {"inserted": len(inserted), "duplicates": duplicates, "invalid_lines": invalid}
 
 def require_admin():
     return session.get("admin")
@@ -127,15 +2211,120 @@ def logout():
     session.pop("admin", None)
     return redirect(url_for("login"))
 
+@app.route("/stats")
+def stats():
+    if not require_admin():
+        return redirect(url_for("login"))
+    return jsonify({
+        "db_pool": pool_stats(),
+        "replica": replica_monitor.stats() if DATABASE_REPLICA_URL else {"configured": False},
+        "key_cache": key_cache.stats(),
+        "lease_revocations": len(lease_revocations),
+        "key_writer": key_writer.stats(),
+        "key_filter": key_filter.stats(),
+        "promo_catalog": promo_catalog.stats(),
+        "expiry_sweeper": expiry_sweeper.stats(),
+        "rate_limit": {"ip": ip_limiter.stats(), "hwid": hwid_limiter.stats()},
+    })
+
 @app.route("/dashboard")
 def dashboard():
     if not require_admin():
         return redirect(url_for("login"))
-    with get_conn() as conn:
+    keys, next_cursor = list_keys(request.args, DASHBOARD_PAGE_SIZE)
+    filters = {name: request.args.get(name, "") for name in
+               ("q", "owner", "hwid", "active", "expires_from", "expires_to")}
+    return render_template("dashboard.html", keys=keys, next_cursor=next_cursor, filters=filters)
+
+@app.route("/api/keys")
+def api_keys():
+    if not require_admin():
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    limit = min(max(request.args.get("limit", DASHBOARD_PAGE_SIZE, type=int), 1), API_PAGE_SIZE_MAX)
+    keys, next_cursor = list_keys(request.args, limit)
+    return jsonify({
+        "status": "ok",
+        "keys": [
+            {
+                "id": k["id"],
+                "key": k["key"],
+                "owner": k["owner"],
+                "hwid": k["hwid"],
+                "active": k["active"],
+                "expires_at": k["expires_at"].strftime("%Y-%m-%d %H:%M:%S") if k["expires_at"] else None,
+            }
+            for k in keys
+        ],
+        "next_cursor": next_cursor
+    })
+
+# Выборки для кампаний продления: обе идут по индексам (expires_at, id) и листаются
+# keyset-курсором "expires_at,id" последней строки
+EXPIRING_KEYS_SQL = """
+    SELECT id, key, owner, hwid, expires_at, last_seen_at FROM keys
+    WHERE active AND expires_at > %s AND expires_at <= %s AND (expires_at, id) > (%s, %s)
+    ORDER BY expires_at, id
+    LIMIT %s
+"""
+EXPIRED_KEYS_SQL = """
+    SELECT id, key, expires_at, created_at AS swept_at FROM key_events
+    WHERE event = 'expired' AND expires_at >= %s AND expires_at < %s AND (expires_at, id) > (%s, %s)
+    ORDER BY expires_at, id
+    LIMIT %s
+"""
+
+def parse_expiry_cursor(value):
+    if not value:
+        return datetime.min, 0
+    expires_at, _, row_id = value.rpartition(",")
+    try:
+        return datetime.fromisoformat(expires_at), int(row_id)
+    except ValueError:
+        return None
+
+def expiry_page(sql, start, end, args):
+    limit = min(max(args.get("limit", DASHBOARD_PAGE_SIZE, type=int), 1), API_PAGE_SIZE_MAX)
+    cursor = parse_expiry_cursor(args.get("cursor"))
+    if cursor is None:
+        return jsonify({"status": "invalid", "reason": "invalid_cursor"}), 400
+    with get_read_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM keys ORDER BY id DESC")
-            keys = cur.fetchall()
-    return render_template("dashboard.html", keys=keys)
+            cur.execute(sql, (start, end, *cursor, limit + 1))
+            rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f"{last['expires_at'].isoformat()},{last['id']}"
+    return jsonify({
+        "status": "ok",
+        "keys": [
+            {name: value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else value
+             for name, value in row.items()}
+            for row in rows[:limit]
+        ],
+        "next_cursor": next_cursor,
+    })
+
+@app.route("/api/keys/expiring")
+def api_keys_expiring():
+    # активные ключи, истекающие в ближайшие days дней
+    if not require_admin():
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    days = min(max(request.args.get("days", 7, type=int), 1), 365)
+    now = datetime.now()
+    return expiry_page(EXPIRING_KEYS_SQL, now, now + timedelta(days=days), request.args)
+
+@app.route("/api/keys/expired")
+def api_keys_expired():
+    # ключи, выключенные sweeper'ом, по дате истечения from..to включительно (по умолчанию 30 дней)
+    if not require_admin():
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    today = datetime.combine(date.today(), datetime.min.time())
+    start = parse_date(request.args["from"]) if request.args.get("from") else today - timedelta(days=30)
+    end = parse_date(request.args["to"]) if request.args.get("to") else today
+    if start is None or end is None or start > end:
+        return jsonify({"status": "invalid", "reason": "invalid_period"}), 400
+    return expiry_page(EXPIRED_KEYS_SQL, start, end + timedelta(days=1), request.args)
 
 @app.route("/generate", methods=["POST"])
 def generate_key():
@@ -153,16 +2342,160 @@ def generate_key():
                 (new_key, expires_at, owner)
             )
             conn.commit()
+    key_filter.add(new_key)
     return redirect(url_for("dashboard"))
 
+@app.route("/generate_bulk", methods=["POST"])
+def generate_bulk():
+    if not require_admin():
+        return redirect(url_for("login"))
+    count = min(max(int(request.form.get("count") or 0), 0), BULK_KEYS_MAX)
+    days = int(request.form.get("days", 30))
+    owner = (request.form.get("owner") or "").strip()
+    keys, expires_at = generate_keys(count, days, owner)
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["key", "expires_at", "owner"])
+    expires = expires_at.strftime("%Y-%m-%d %H:%M:%S")
+    for key in keys:
+        writer.writerow([key, expires, owner])
+    return Response(
+        out.getvalue(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=keys_{len(keys)}.csv"}
+    )
+
+@app.route("/import_keys", methods=["POST"])
+def import_keys_route():
+    if not require_admin():
+        return redirect(url_for("login"))
+    upload = request.files.get("file")
+    if not upload:
+        return jsonify({"status": "invalid", "reason": "missing_file"}), 400
+    days = int(request.form.get("days", 30))
+    owner = (request.form.get("owner") or "").strip()
+    lines = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    report = import_keys(lines, days, owner)
+    return jsonify(dict(report, status="ok"))
+
+# ---------------- Выгрузки ----------------
+# sql, колонка для фильтра from/to и колонка автора для фильтра creator_id
+EXPORTS = {
+    "keys": {
+        "sql": "SELECT id, key, owner, hwid, active, expires_at, last_seen_at, client_version FROM keys",
+        "date_column": "expires_at",
+        "creator_column": None,
+    },
+    "redemptions": {
+        "sql": """
+            SELECT r.id, r.code, r.key, r.hwid, r.redeemed_at, p.creator_id
+            FROM promo_redemptions r
+            LEFT JOIN promo_codes p ON p.code = r.code
+        """,
+        "date_column": "r.redeemed_at",
+        "creator_column": "p.creator_id",
+    },
+    "purchases": {
+        "sql": "SELECT id, key, amount, code, creator_id, purchased_at FROM purchases",
+        "date_column": "purchased_at",
+        "creator_column": "creator_id",
+    },
+}
+
+def export_query(kind, args):
+    spec = EXPORTS[kind]
+    where, params = key_filters(args) if kind == "keys" else ([], [])
+    date_from = parse_date(args.get("from"))
+    if date_from:
+        where.append(f"{spec['date_column']} >= %s")
+        params.append(date_from)
+    date_to = parse_date(args.get("to"))
+    if date_to:
+        where.append(f"{spec['date_column']} < %s")
+        params.append(date_to + timedelta(days=1))
+    creator_id = args.get("creator_id", type=int)
+    if creator_id and spec["creator_column"]:
+        where.append(f"{spec['creator_column']} = %s")
+        params.append(creator_id)
+    sql = spec["sql"]
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params
+
+def stream_rows(sql, params, replica=False):
+    # именованный (серверный) курсор: строки приходят порциями по EXPORT_FETCH_SIZE,
+    # память воркера не зависит от размера выгрузки
+    with get_read_conn(replica) as conn:
+        with conn.cursor(name="export") as cur:
+            cur.itersize = EXPORT_FETCH_SIZE
+            cur.execute(sql, params)
+            yield from cur
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+def stream_csv(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    header = False
+    for n, row in enumerate(rows, start=1):
+        if not header:
+            writer.writerow(row.keys())
+            header = True
+        writer.writerow(export_value(v) for v in row.values())
+        if n % EXPORT_FETCH_SIZE == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+def stream_ndjson(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps({k: export_value(v) for k, v in row.items()}, default=str, ensure_ascii=False))
+        if len(chunk) >= EXPORT_FETCH_SIZE:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+@app.route("/export/<kind>")
+def export(kind):
+    if not require_admin():
+        return redirect(url_for("login"))
+    if kind not in EXPORTS:
+        return jsonify({"status": "invalid", "reason": "unknown_export"}), 404
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"status": "invalid", "reason": "unknown_format"}), 400
+
+    sql, params = export_query(kind, request.args)
+    # генератор читает уже после выхода из роута — где читать, решаем сейчас
+    rows = stream_rows(sql + " ORDER BY 1", params, replica=use_replica())
+    body = stream_csv(rows) if fmt == "csv" else stream_ndjson(rows)
+    return Response(
+        body,
+        mimetype="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={
+            "Content-Disposition": f"attachment; filename={kind}.{fmt}",
+            # не буферизовать ответ на nginx
+            "X-Accel-Buffering": "no",
+        }
+    )
+
 @app.route("/activate/<path:key>")
 def activate_key(key):
     if not require_admin():
         return redirect(url_for("login"))
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("UPDATE keys SET active=TRUE WHERE key=%s", (key,))
+            cur.execute("UPDATE keys SET active=TRUE, swept_at=NULL WHERE key=%s", (key,))
+            notify_change(cur, "key", key)
             conn.commit()
+    key_cache.invalidate(key)
     return redirect(url_for("dashboard"))
 
 @app.route("/deactivate/<path:key>")
@@ -171,8 +2504,11 @@ def deactivate_key(key):
         return redirect(url_for("login"))
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("UPDATE keys SET active=FALSE WHERE key=%s", (key,))
+            cur.execute("UPDATE keys SET active=FALSE, swept_at=NULL WHERE key=%s", (key,))
+            revoke_leases(cur, key)
+            notify_change(cur, "key", key)
             conn.commit()
+    key_cache.invalidate(key)
     return redirect(url_for("dashboard"))
 
 @app.route("/delete/<path:key>", methods=["POST"])
@@ -182,7 +2518,10 @@ def delete_key(key):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM keys WHERE key=%s", (key,))
+            revoke_leases(cur, key)
+            notify_change(cur, "key", key)
             conn.commit()
+    key_cache.invalidate(key)
     return redirect(url_for("dashboard"))
 
 @app.route("/edit_owner/<path:key>", methods=["POST"])
@@ -193,7 +2532,9 @@ def edit_owner(key):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("UPDATE keys SET owner=%s WHERE key=%s", (owner, key))
+            notify_change(cur, "key", key)
             conn.commit()
+    key_cache.invalidate(key)
     return redirect(url_for("dashboard"))
 
 @app.route("/reset_hwid/<path:key>")
@@ -203,7 +2544,10 @@ def reset_hwid(key):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("UPDATE keys SET hwid='' WHERE key=%s", (key,))
+            revoke_leases(cur, key)
+            notify_change(cur, "key", key)
             conn.commit()
+    key_cache.invalidate(key)
     return redirect(url_for("dashboard"))
 
 @app.route("/check_key", methods=["POST"])
@@ -214,52 +2558,83 @@ def check_key():
 
     if not key or not hwid:
         return jsonify({"status": "invalid", "reason": "missing_data"})
+    if throttled(client_ip(request.remote_addr, request.headers), hwid):
+        return jsonify(RATE_LIMITED_RESPONSE), 429, {"Retry-After": "1"}
 
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            # берём owner, active, expires_at, hwid
-            cur.execute(
-                "SELECT owner, active, expires_at, hwid FROM keys WHERE key=%s", 
-                (key,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return jsonify({"status": "invalid", "reason": "not_found"})
-
-            owner, active, expires_at, saved_hwid = (
-                row["owner"], row["active"], row["expires_at"], row["hwid"]
-            )
+    now = datetime.now()
+    row = key_cache.get(key)
+    if row is None or not row["active"] or row["expires_at"] <= now:
+        if not key_filter.check(key):
+            return jsonify({"status": "invalid", "reason": "not_found"})
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                # берём owner, active, expires_at, hwid
+                cur.execute(KEY_LOOKUP_SQL, (key,))
+                row = cur.fetchone()
+        if not row:
+            return jsonify({"status": "invalid", "reason": "not_found"})
+        if cacheable_key(row, now):
+            key_cache.set(key, row)
+
+    result = key_check_result(key, row, hwid, now)
+    if result["status"] == "ok" and not row["hwid"]:
+        # первая привязка: соединение уже вернули в пул, ждём общего UPDATE
+        saved = key_writer.bind({key: hwid})[key]
+        if saved is None:
+            return jsonify({"status": "invalid", "reason": "not_found"})
+        result = key_check_result(key, dict(row, hwid=saved), hwid, now)
+    if result["status"] == "ok":
+        key_writer.touch(key, client_version(data), now)
+
+    return jsonify(with_lease(result, data, now))
+
+@app.route("/lease/renew", methods=["POST"])
+def lease_renew():
+    if _lease_signer is None:
+        return jsonify({"status": "invalid", "reason": "leases_disabled"}), 404
+    data = request.json or {}
+    return jsonify(renew_lease(data.get("lease"), (data.get("hwid") or "").strip()))
 
-            if not active:
-                return jsonify({"status": "invalid", "reason": "inactive"})
+@app.route("/lease/public_key", methods=["GET"])
+def lease_public_key_route():
+    if _lease_signer is None:
+        return jsonify({"status": "invalid", "reason": "leases_disabled"}), 404
+    return jsonify({"alg": "Ed25519", "public_key": lease_public_key(), "ttl": LEASE_TTL})
 
-            if expires_at <= datetime.now():
-                return jsonify({"status": "invalid", "reason": "expired"})
+@app.route("/check_keys", methods=["POST"])
+def check_keys():
+    data = request.json or {}
+    pairs = parse_key_pairs(data)
+    if pairs is None:
+        return jsonify({"status": "invalid", "reason": "missing_data"}), 400
+    if len(pairs) > CHECK_KEYS_MAX:
+        return jsonify({"status": "invalid", "reason": "too_many_keys", "max": CHECK_KEYS_MAX}), 400
+    if throttled(client_ip(request.remote_addr, request.headers), cost=len(pairs)):
+        return jsonify(RATE_LIMITED_RESPONSE), 429, {"Retry-After": "1"}
 
-            if not saved_hwid:
-                cur.execute(
-                    "UPDATE keys SET hwid=%s WHERE key=%s", 
-                    (hwid, key)
-                )
-                conn.commit()
-            elif saved_hwid != hwid:
-                return jsonify({"status": "invalid", "reason": "hwid_mismatch"})
-
-            # время до окончания
-            delta = expires_at - datetime.now()
-            days_left = delta.days
-            hours_left = delta.seconds // 3600
-
-            return jsonify({
-                "status": "ok",
-                "key": key,
-                "owner": owner,
-                "active": True,
-                "hwid": saved_hwid or hwid,
-                "expires_at": expires_at.strftime("%Y-%m-%d %H:%M:%S"),
-                "days_left": days_left,
-                "hours_left": hours_left
-            })
+    now = datetime.now()
+    rows, missing = cached_key_rows(pairs, now)
+    missing = [key for key in missing if key_filter.check(key)]
+    if missing:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(KEYS_LOOKUP_SQL, (missing,))
+                for row in cur.fetchall():
+                    rows[row["key"]] = row
+                    if cacheable_key(row, now):
+                        key_cache.set(row["key"], row)
+
+    binds = pending_binds(pairs, rows, now)
+    if binds:
+        for key, saved_hwid in key_writer.bind(binds).items():
+            apply_bind(rows, key, saved_hwid)
+
+    results = batch_results(pairs, rows, now)
+    version = client_version(data) if isinstance(data, dict) else ""
+    for result in results:
+        if result["status"] == "ok":
+            key_writer.touch(result["key"], version, now)
+    return jsonify({"status": "ok", "results": results})
 
 # ---------------- РОУТ: referrals ----------------
 @app.route("/referrals")
@@ -267,7 +2642,7 @@ def referrals():
     if not require_admin():
         return redirect(url_for("login"))
 
-    with get_conn() as conn:
+    with get_read_conn() as conn:
         with conn.cursor() as cur:
             # Контент‑мейкеры
             cur.execute("SELECT * FROM creators ORDER BY id DESC")
@@ -282,23 +2657,27 @@ def referrals():
             """)
             codes = cur.fetchall()
 
-            # Статистика по промокодам
-            cur.execute("""
-                SELECT code, COUNT(*) AS uses
-                FROM promo_redemptions
-                GROUP BY code
-            """)
+            # Статистика по промокодам и авторам — из агрегатов (bump_referral_stats)
+            cur.execute("SELECT code, redemptions AS uses FROM promo_code_stats")
             stats = {row["code"]: row["uses"] for row in cur.fetchall()}
 
-            # Статистика по авторам
+            cur.execute("SELECT creator_id AS id, redemptions AS uses FROM creator_stats")
+            creator_stats = {row["id"]: row["uses"] for row in cur.fetchall()}
+
+            # По дням за последние две недели
             cur.execute("""
-                SELECT c.id, COUNT(r.id) AS uses
-                FROM creators c
-                LEFT JOIN promo_codes p ON p.creator_id = c.id
-                LEFT JOIN promo_redemptions r ON r.code = p.code
-                GROUP BY c.id
+                SELECT day, SUM(redemptions) AS redemptions, SUM(purchases) AS purchases,
+                       SUM(revenue) AS revenue, SUM(commission) AS commission
+                FROM referral_daily_stats
+                WHERE day > CURRENT_DATE - 14
+                GROUP BY day
+                ORDER BY day DESC
             """)
-            creator_stats = {row["id"]: row["uses"] for row in cur.fetchall()}
+            daily_stats = cur.fetchall()
+
+            # Комиссии авторов за текущий месяц
+            today = date.today()
+            commissions = commission_report(cur, today.replace(day=1), today)
 
             # История применений
             cur.execute("""
@@ -314,6 +2693,8 @@ def referrals():
         codes=codes,
         stats=stats,
         creator_stats=creator_stats,
+        daily_stats=daily_stats,
+        commissions=commissions,
         redemptions=redemptions
     )
 
@@ -334,9 +2715,16 @@ def creator_create():
                 INSERT INTO creators (nickname, yt_url, tt_url, ig_url, commission_percent, note, active)
                 VALUES (%s,%s,%s,%s,%s,%s,TRUE)
             """, (nickname, yt_url, tt_url, ig_url, commission_percent, note))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
     
+PROMO_REDEEM_RESPONSE = {
+    "success": True,
+    "bonus_days": 7,
+    "message": "Промокод применён, +7 дней!"
+}
+
 @app.route("/promo/redeem", methods=["POST"])
 def promo_redeem():
     data = request.get_json()
@@ -345,11 +2733,7 @@ def promo_redeem():
     promo = data.get("promo")
 
     # здесь твоя логика проверки промокода
-    return jsonify({
-        "success": True,
-        "bonus_days": 7,
-        "message": "Промокод применён, +7 дней!"
-    })
+    return jsonify(PROMO_REDEEM_RESPONSE)
 
 @app.route("/creator/toggle/<int:creator_id>")
 def creator_toggle(creator_id):
@@ -358,6 +2742,7 @@ def creator_toggle(creator_id):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("UPDATE creators SET active = NOT active WHERE id=%s", (creator_id,))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
 
@@ -368,6 +2753,7 @@ def creator_delete(creator_id):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM creators WHERE id=%s", (creator_id,))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
 
@@ -389,6 +2775,7 @@ def promo_create():
                 INSERT INTO promo_codes (code, creator_id, bonus_days, max_uses, end_at, only_new_users, note, active, start_at)
                 VALUES (%s,%s,%s,%s,%s,%s,%s,TRUE,NOW())
             """, (code, creator_id, bonus_days, max_uses, end_at, only_new, note))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
 
@@ -399,6 +2786,7 @@ def promo_toggle(code):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("UPDATE promo_codes SET active = NOT active WHERE code=%s", (code,))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
 
@@ -409,9 +2797,160 @@ def promo_delete(code):
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM promo_codes WHERE code=%s", (code,))
+            notify_change(cur, "catalog")
             conn.commit()
     return redirect(url_for("referrals"))
 
+# ---------------- Каталог промокодов и оповещения ----------------
+# Изменения из админки рассылаются через NOTIFY в той же транзакции (доставка — после COMMIT):
+# "catalog" — перечитать промокоды, "key:<ключ>" — сбросить ключ из key_cache во всех воркерах.
+CHANGES_CHANNEL = "crossfocusx_changes"  # то же имя зашито в notify_keys_inserted()
+
+def notify_change(cur, kind, value=""):
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANGES_CHANNEL, f"{kind}:{value}" if value else kind))
+
+PROMO_CATALOG_SQL = """
+    SELECT p.code, p.active, p.start_at, p.end_at, p.creator_id, c.nickname AS creator
+    FROM promo_codes p LEFT JOIN creators c ON c.id = p.creator_id
+"""
+
+class PromoCatalog:
+    # Снимок promo_codes (+ ник автора) и поток LISTEN в каждом процессе; поток запускается
+    # на первом запросе воркера (start) и разносит также сбросы key_cache.
+    # Снимком отсекаются заведомо неприменимые коды; всё остальное (лимиты, антифрод, сам бонус)
+    # по-прежнему решает apply_promo_code атомарно. Пока LISTEN не подключён, снимку не верим:
+    # пропущенное оповещение означало бы отказ по устаревшим данным.
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._codes = None
+        self._pid = None
+        self._listening = False
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.rejected = 0
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._codes, self._listening = None, False
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="promo-catalog", daemon=True).start()
+
+    def reload(self):
+        if not PROMO_CATALOG_ENABLED:
+            return
+        with get_conn() as conn:
+            rows = conn.execute(PROMO_CATALOG_SQL).fetchall()
+        self._codes = {row["code"]: row for row in rows}
+        self.reloads += 1
+
+    def _handle(self, payload):
+        kind, _, value = payload.partition(":")
+        if kind == "key":
+            key_cache.invalidate(value)
+        elif kind == "keys":
+            first_id, _, last_id = value.partition(":")
+            key_filter.add_range(int(first_id), int(last_id))
+        elif kind == "catalog":
+            self.reload()
+
+    def _run(self):
+        while True:
+            try:
+                with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANGES_CHANNEL}")
+                    key_filter.listener_connected()
+                    # перечитываем уже после LISTEN: изменение между загрузкой и подпиской не потеряется
+                    self.reload()
+                    self._listening = True
+                    while True:
+                        for notify in conn.notifies(timeout=self.max_age):
+                            self._handle(notify.payload)
+                        self.reload()
+            except psycopg.Error:
+                app.logger.exception("promo catalog: listener disconnected")
+            self._listening = False
+            key_filter.listener_lost()
+            time.sleep(1)
+
+    def check(self, code, now):
+        # причина отказа по снимку или None, если решать должна БД
+        if not PROMO_CATALOG_ENABLED:
+            return None
+        codes = self._codes
+        if codes is None or not self._listening:
+            return None
+        promo = codes.get(code)
+        if promo is None:
+            reason = "promo_not_found"
+        elif not promo["active"]:
+            reason = "promo_inactive"
+        elif promo["start_at"] is not None and promo["start_at"] > now:
+            reason = "promo_not_started"
+        elif promo["end_at"] is not None and promo["end_at"] < now:
+            reason = "promo_expired"
+        else:
+            return None
+        self.rejected += 1
+        return reason
+
+    def stats(self):
+        return {
+            "enabled": PROMO_CATALOG_ENABLED,
+            "listening": self._listening,
+            "codes": len(self._codes) if self._codes is not None else None,
+            "reloads": self.reloads,
+            "rejected": self.rejected,
+        }
+
+promo_catalog = PromoCatalog(PROMO_CATALOG_MAX_AGE)
+
+@app.before_request
+def start_change_listener():
+    promo_catalog.start()
+
+def promo_precheck(code, key, hwid, now):
+    # Снимок решает только за заведомо годный ключ (из key_cache: активен, не истёк, уже привязан
+    # к этому hwid). Иначе порядок причин — ключ, затем промокод — остаётся за apply_promo_code.
+    row = key_cache.get(key)
+    if row is None or key_check_result(key, row, hwid, now)["status"] != "ok":
+        return None
+    return promo_catalog.check(code, now)
+
+# HTTP-статус для каждого отказа apply_promo_code()
+PROMO_REJECT_STATUS = {
+    "key_not_found": 404,
+    "key_inactive": 403,
+    "key_expired": 403,
+    "hwid_mismatch": 403,
+    "promo_not_found": 404,
+    "promo_inactive": 403,
+    "promo_not_started": 403,
+    "promo_expired": 403,
+    "already_redeemed": 409,
+    "promo_limit_reached": 409,
+    "not_new_user": 403,
+}
+
+APPLY_PROMO_SQL = "SELECT * FROM apply_promo_code(%s, %s, %s)"
+
+def promo_result(code, row, now=None):
+    now = now or datetime.now()
+    if row["reason"] != "ok":
+        return {"status": "invalid", "reason": row["reason"]}, PROMO_REJECT_STATUS[row["reason"]]
+    delta = row["new_expires_at"] - now
+    return {
+        "status": "ok",
+        "code": code,
+        "creator": row["creator"],
+        "bonus_days": row["bonus_days"],
+        "new_expires_at": row["new_expires_at"].strftime("%Y-%m-%d %H:%M:%S"),
+        "days_left": delta.days,
+        "hours_left": delta.seconds // 3600
+    }, 200
+
 @app.route("/apply_promo", methods=["POST"])
 def apply_promo():
     data = request.json or {}
@@ -420,110 +2959,314 @@ def apply_promo():
     hwid = (data.get("hwid") or "").strip()
     if not code or not key or not hwid:
         return jsonify({"status": "invalid", "reason": "missing_data"}), 400
-    now = datetime.now()
+    if throttled(client_ip(request.remote_addr, request.headers), hwid):
+        return jsonify(RATE_LIMITED_RESPONSE), 429, {"Retry-After": "1"}
+    if not key_filter.check(key):
+        result, status = promo_result(code, {"reason": "key_not_found"})
+        return jsonify(result), status
+    reason = promo_precheck(code, key, hwid, datetime.now())
+    if reason:
+        result, status = promo_result(code, {"reason": reason})
+        return jsonify(result), status
     with get_conn() as conn:
         with conn.cursor() as cur:
-            # Проверяем ключ
-            cur.execute("SELECT id, expires_at, active, hwid AS saved_hwid FROM keys WHERE key=%s", (key,))
-            k = cur.fetchone()
-            if not k:
-                return jsonify({"status": "invalid", "reason": "key_not_found"}), 404
-            if not k["active"]:
-                return jsonify({"status": "invalid", "reason": "key_inactive"}), 403
-            if k["expires_at"] <= now:
-                return jsonify({"status": "invalid", "reason": "key_expired"}), 403
-            if k["saved_hwid"] and k["saved_hwid"] != hwid:
-                return jsonify({"status": "invalid", "reason": "hwid_mismatch"}), 403
-            if not k["saved_hwid"]:
-                cur.execute("UPDATE keys SET hwid=%s WHERE id=%s", (hwid, k["id"]))
-
-            # Проверяем промокод
-            cur.execute("""
-                SELECT p.*, c.nickname AS creator_nickname
-                FROM promo_codes p
-                LEFT JOIN creators c ON c.id = p.creator_id
-                WHERE p.code=%s
-            """, (code,))
-            p = cur.fetchone()
-            if not p:
-                return jsonify({"status": "invalid", "reason": "promo_not_found"}), 404
-            if not p["active"]:
-                return jsonify({"status": "invalid", "reason": "promo_inactive"}), 403
-            if p["start_at"] and p["start_at"] > now:
-                return jsonify({"status": "invalid", "reason": "promo_not_started"}), 403
-            if p["end_at"] and p["end_at"] < now:
-                return jsonify({"status": "invalid", "reason": "promo_expired"}), 403
-
-            # Антифрод: один раз на связку key+hwid
-            cur.execute("""
-                SELECT 1 FROM promo_redemptions
-                WHERE code=%s AND key=%s AND hwid=%s
-            """, (code, key, hwid))
-            if cur.fetchone():
-                return jsonify({"status": "invalid", "reason": "already_redeemed"}), 409
-
-            # Лимит применений
-            if p["max_uses"] and p["max_uses"] > 0:
-                cur.execute("SELECT COUNT(*) AS used FROM promo_redemptions WHERE code=%s", (code,))
-                used = cur.fetchone()["used"]
-                if used >= p["max_uses"]:
-                    return jsonify({"status": "invalid", "reason": "promo_limit_reached"}), 409
-
-            # «Только для новых»
-            if p["only_new_users"]:
-                cur.execute("SELECT 1 FROM promo_redemptions WHERE key=%s", (key,))
-                if cur.fetchone():
-                    return jsonify({"status": "invalid", "reason": "not_new_user"}), 403
-
-            # Применяем бонус
-            bonus_days = int(p["bonus_days"] or 7)
-            new_expires = k["expires_at"] + timedelta(days=bonus_days)
-            cur.execute("UPDATE keys SET expires_at=%s WHERE id=%s", (new_expires, k["id"]))
-
-            # Логируем применение
-            cur.execute("""
-                INSERT INTO promo_redemptions (code, key, hwid)
-                VALUES (%s, %s, %s)
-            """, (code, key, hwid))
+            # проверка ключа и промокода, лимиты и применение — один вызов (см. миграцию 4)
+            cur.execute(APPLY_PROMO_SQL, (code, key, hwid))
+            row = cur.fetchone()
+    if row["reason"] == "ok":
+        key_cache.invalidate(key)
+    result, status = promo_result(code, row)
+    return jsonify(result), status
+
+# ---------------- Покупки и комиссии ----------------
+CENT = Decimal("0.01")
+PURCHASE_AMOUNT_MAX = Decimal("99999999.99")  # NUMERIC(10,2)
+IDEMPOTENCY_KEY_MAX = 200
+
+# Занимает ключи идемпотентности; ключ, занятый параллельной транзакцией, ждёт её завершения.
+# Сортировка — одинаковый порядок блокировок у пересекающихся пачек.
+PURCHASE_IDEMPOTENCY_SQL = """
+    INSERT INTO purchase_idempotency (idempotency_key)
+    SELECT k FROM unnest(%s::text[]) k ORDER BY k
+    ON CONFLICT DO NOTHING
+    RETURNING idempotency_key
+"""
+PURCHASE_IDEMPOTENCY_LINK_SQL = """
+    UPDATE purchase_idempotency i SET purchase_id = t.purchase_id
+    FROM unnest(%s::text[], %s::integer[]) AS t(idempotency_key, purchase_id)
+    WHERE i.idempotency_key = t.idempotency_key
+"""
+PURCHASE_IDEMPOTENCY_LOOKUP_SQL = """
+    SELECT idempotency_key, purchase_id FROM purchase_idempotency WHERE idempotency_key = ANY(%s)
+"""
+# все промокоды пачки -> автор и его процент одним запросом
+PURCHASE_CODES_SQL = """
+    SELECT p.code, p.creator_id, c.commission_percent
+    FROM promo_codes p LEFT JOIN creators c ON c.id = p.creator_id
+    WHERE p.code = ANY(%s)
+"""
+PURCHASE_IDS_SQL = "SELECT nextval('purchases_id_seq') AS id FROM generate_series(1, %s)"
+PURCHASES_INSERT_SQL = """
+    INSERT INTO purchases (id, key, amount, commission, code, creator_id, purchased_at)
+    SELECT id, key, amount, commission, code, creator_id, COALESCE(purchased_at, LOCALTIMESTAMP)
+    FROM unnest(%s::integer[], %s::text[], %s::numeric[], %s::numeric[], %s::text[], %s::integer[],
+                %s::timestamp[]) AS t(id, key, amount, commission, code, creator_id, purchased_at)
+    RETURNING id, purchased_at
+"""
+# Агрегаты /referrals по всей пачке — по одному upsert на таблицу, строки отсортированы,
+# порядок таблиц как в bump_referral_stats: code -> creator -> day.
+PURCHASE_STATS_SQL = [
+    """
+    INSERT INTO promo_code_stats AS s (code, purchases, revenue)
+    SELECT * FROM unnest(%s::text[], %s::bigint[], %s::numeric[]) ORDER BY 1
+    ON CONFLICT (code) DO UPDATE SET
+        purchases = s.purchases + EXCLUDED.purchases,
+        revenue = s.revenue + EXCLUDED.revenue
+    """,
+    """
+    INSERT INTO creator_stats AS s (creator_id, purchases, revenue, commission)
+    SELECT * FROM unnest(%s::integer[], %s::bigint[], %s::numeric[], %s::numeric[]) ORDER BY 1
+    ON CONFLICT (creator_id) DO UPDATE SET
+        purchases = s.purchases + EXCLUDED.purchases,
+        revenue = s.revenue + EXCLUDED.revenue,
+        commission = s.commission + EXCLUDED.commission
+    """,
+    """
+    INSERT INTO referral_daily_stats AS s (day, creator_id, purchases, revenue, commission)
+    SELECT * FROM unnest(%s::date[], %s::integer[], %s::bigint[], %s::numeric[], %s::numeric[]) ORDER BY 1, 2
+    ON CONFLICT (day, creator_id) DO UPDATE SET
+        purchases = s.purchases + EXCLUDED.purchases,
+        revenue = s.revenue + EXCLUDED.revenue,
+        commission = s.commission + EXCLUDED.commission
+    """,
+]
+
+def purchase_commission(amount, percent):
+    return (amount * (percent or 0) / 100).quantize(CENT, ROUND_HALF_UP)
+
+def parse_amount(value):
+    try:
+        amount = Decimal(str(value).strip()).quantize(CENT, ROUND_HALF_UP)
+    except (InvalidOperation, ValueError):
+        return None
+    return amount if 0 <= amount <= PURCHASE_AMOUNT_MAX else None
+
+def parse_purchased_at(value):
+    # ISO 8601; время с часовым поясом переводится в локальное, как NOW() в колонке TIMESTAMP
+    try:
+        value = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+def parse_purchase(item):
+    # -> (покупка, None) или (None, причина)
+    if not isinstance(item, dict):
+        return None, "missing_data"
+    idempotency_key = item.get("idempotency_key")
+    if not isinstance(idempotency_key, str) or not idempotency_key.strip() \
+            or len(idempotency_key) > IDEMPOTENCY_KEY_MAX:
+        return None, "invalid_idempotency_key"
+    key = item.get("key")
+    if not isinstance(key, str) or not key.strip():
+        return None, "invalid_key"
+    amount = parse_amount(item.get("amount")) if item.get("amount") is not None else None
+    if amount is None:
+        return None, "invalid_amount"
+    code = item.get("code") or ""
+    if not isinstance(code, str):
+        return None, "invalid_code"
+    purchased_at = None
+    if item.get("purchased_at") is not None:
+        purchased_at = parse_purchased_at(item["purchased_at"])
+        if purchased_at is None:
+            return None, "invalid_purchased_at"
+    return {
+        "idempotency_key": idempotency_key.strip(),
+        "key": key.strip().upper(),
+        "amount": amount,
+        "code": code.strip().upper(),
+        "purchased_at": purchased_at,
+    }, None
+
+def bump_purchase_stats(cur, rows):
+    # rows: (creator_id, code, purchased_at, amount, commission)
+    by_code, by_creator, by_day = {}, {}, {}
+    for creator_id, code, purchased_at, amount, commission in rows:
+        if code:
+            count, revenue = by_code.get((code,), (0, 0))
+            by_code[(code,)] = (count + 1, revenue + amount)
+        if creator_id is not None:
+            count, revenue, total = by_creator.get((creator_id,), (0, 0, 0))
+            by_creator[(creator_id,)] = (count + 1, revenue + amount, total + commission)
+        day = (purchased_at.date(), creator_id or 0)
+        count, revenue, total = by_day.get(day, (0, 0, 0))
+        by_day[day] = (count + 1, revenue + amount, total + commission)
+    for sql, totals in zip(PURCHASE_STATS_SQL, (by_code, by_creator, by_day)):
+        if totals:
+            rows = [group + values for group, values in sorted(totals.items())]
+            cur.execute(sql, [list(column) for column in zip(*rows)])
+
+def ingest_purchases(purchases):
+    # Пачка покупок одной транзакцией: ключи идемпотентности, покупки и агрегаты /referrals.
+    # Повтор idempotency_key (ретрай провайдера или повтор внутри пачки) покупку не создаёт,
+    # а возвращает id уже записанной; idempotency_key = None — всегда новая покупка.
+    results = [None] * len(purchases)
+    first = {}
+    for i, purchase in enumerate(purchases):
+        if purchase["idempotency_key"] is not None:
+            first.setdefault(purchase["idempotency_key"], i)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            claimed = set()
+            if first:
+                cur.execute(PURCHASE_IDEMPOTENCY_SQL, (sorted(first),))
+                claimed = {row["idempotency_key"] for row in cur.fetchall()}
+            new = [
+                i for i, purchase in enumerate(purchases)
+                if purchase["idempotency_key"] is None
+                or (purchase["idempotency_key"] in claimed and first[purchase["idempotency_key"]] == i)
+            ]
+
+            known = {}
+            if new:
+                codes = sorted({purchases[i]["code"] for i in new if purchases[i]["code"]})
+                promos = {}
+                if codes:
+                    cur.execute(PURCHASE_CODES_SQL, (codes,))
+                    promos = {row["code"]: row for row in cur.fetchall()}
+                cur.execute(PURCHASE_IDS_SQL, (len(new),))
+                rows = []
+                for row, i in zip(cur.fetchall(), new):
+                    purchase = purchases[i]
+                    promo = promos.get(purchase["code"]) or {}
+                    creator_id = promo.get("creator_id")
+                    commission = purchase_commission(purchase["amount"], promo.get("commission_percent"))
+                    rows.append((
+                        row["id"], purchase["key"], purchase["amount"], commission,
+                        purchase["code"] or None, creator_id, purchase["purchased_at"],
+                    ))
+                    results[i] = {"status": "created", "purchase_id": row["id"]}
+                    if purchase["idempotency_key"] is not None:
+                        known[purchase["idempotency_key"]] = row["id"]
+                cur.execute(PURCHASES_INSERT_SQL, [list(column) for column in zip(*rows)])
+                purchased_at = {row["id"]: row["purchased_at"] for row in cur.fetchall()}
+                if known:
+                    cur.execute(PURCHASE_IDEMPOTENCY_LINK_SQL, (list(known), list(known.values())))
+                bump_purchase_stats(cur, [
+                    (creator_id, code, purchased_at[purchase_id], amount, commission)
+                    for purchase_id, _, amount, commission, code, creator_id, _ in rows
+                ])
+
+            retried = sorted(set(first) - set(known))
+            if retried:
+                cur.execute(PURCHASE_IDEMPOTENCY_LOOKUP_SQL, (retried,))
+                known.update((row["idempotency_key"], row["purchase_id"]) for row in cur.fetchall())
             conn.commit()
-
-            delta = new_expires - now
-            return jsonify({
-                "status": "ok",
-                "code": code,
-                "creator": p["creator_nickname"],
-                "bonus_days": bonus_days,
-                "new_expires_at": new_expires.strftime("%Y-%m-%d %H:%M:%S"),
-                "days_left": delta.days,
-                "hours_left": delta.seconds // 3600
-            })
+    for i, purchase in enumerate(purchases):
+        if results[i] is None:
+            results[i] = {"status": "duplicate", "purchase_id": known.get(purchase["idempotency_key"])}
+    return results
 
 @app.route("/purchase/create", methods=["POST"])
 def purchase_create():
     if not require_admin():
         return redirect(url_for("login"))
-    key = (request.form.get("key") or "").strip().upper()
-    amount = float(request.form.get("amount") or 0)
-    code = (request.form.get("code") or "").strip().upper()
-
-    creator_id = None
-    if code:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT creator_id FROM promo_codes WHERE code=%s", (code,))
-                row = cur.fetchone()
-                if row:
-                    creator_id = row["creator_id"]
-            conn.commit()
+    amount = parse_amount(request.form.get("amount") or 0)
+    if amount is not None:
+        ingest_purchases([{
+            "idempotency_key": None,
+            "key": (request.form.get("key") or "").strip().upper(),
+            "amount": amount,
+            "code": (request.form.get("code") or "").strip().upper(),
+            "purchased_at": None,
+        }])
+    return redirect(url_for("referrals"))
 
-    with get_conn() as conn:
+@app.route("/api/purchases/batch", methods=["POST"])
+def purchases_batch():
+    token = request.headers.get("Authorization") or ""
+    if not require_admin() and not (INGEST_TOKEN and secrets.compare_digest(token, f"Bearer {INGEST_TOKEN}")):
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    data = request.get_json(silent=True)
+    items = data.get("purchases") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"status": "invalid", "reason": "missing_data"}), 400
+    if len(items) > PURCHASE_BATCH_MAX:
+        return jsonify({"status": "invalid", "reason": "too_many_purchases", "max": PURCHASE_BATCH_MAX}), 400
+
+    # невалидные позиции отклоняются по отдельности, остальная пачка записывается
+    results, purchases, positions = [], [], []
+    for item in items:
+        purchase, reason = parse_purchase(item)
+        if purchase is None:
+            key = item.get("idempotency_key") if isinstance(item, dict) else None
+            results.append({"idempotency_key": key, "status": "invalid", "reason": reason})
+        else:
+            positions.append(len(results))
+            purchases.append(purchase)
+            results.append(None)
+    if purchases:
+        for position, purchase, result in zip(positions, purchases, ingest_purchases(purchases)):
+            results[position] = {"idempotency_key": purchase["idempotency_key"], **result}
+
+    counts = {status: 0 for status in ("created", "duplicate", "invalid")}
+    for result in results:
+        counts[result["status"]] += 1
+    return jsonify({"status": "ok", **counts, "results": results})
+
+# Комиссии по авторам за период — из дневных агрегатов (ведутся инкрементально),
+# процент — тот, что был у автора в момент покупки
+COMMISSION_REPORT_SQL = """
+    SELECT c.id AS creator_id, c.nickname, c.commission_percent,
+           COALESCE(SUM(d.purchases), 0)::bigint AS purchases,
+           COALESCE(SUM(d.revenue), 0) AS revenue,
+           COALESCE(SUM(d.commission), 0) AS commission
+    FROM creators c
+    LEFT JOIN referral_daily_stats d ON d.creator_id = c.id AND d.day BETWEEN %s AND %s
+    GROUP BY c.id
+    ORDER BY commission DESC, c.id
+"""
+
+def commission_report(cur, start, end):
+    cur.execute(COMMISSION_REPORT_SQL, (start, end))
+    return cur.fetchall()
+
+@app.route("/reports/commissions")
+def commissions_report():
+    if not require_admin():
+        return jsonify({"status": "invalid", "reason": "unauthorized"}), 401
+    # по умолчанию — текущий месяц; границы включительно
+    today = date.today()
+    start = parse_date(request.args["from"]) if request.args.get("from") else datetime(today.year, today.month, 1)
+    end = parse_date(request.args["to"]) if request.args.get("to") else datetime(today.year, today.month, today.day)
+    if start is None or end is None or start > end:
+        return jsonify({"status": "invalid", "reason": "invalid_period"}), 400
+
+    with get_read_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO purchases (key, amount, code, creator_id)
-                VALUES (%s, %s, %s, %s)
-            """, (key, amount, code or None, creator_id))
-            conn.commit()
-    return redirect(url_for("referrals"))
+            rows = commission_report(cur, start.date(), end.date())
+    return jsonify({
+        "status": "ok",
+        "from": start.strftime("%Y-%m-%d"),
+        "to": end.strftime("%Y-%m-%d"),
+        "creators": [
+            {
+                "creator_id": row["creator_id"],
+                "nickname": row["nickname"],
+                "commission_percent": row["commission_percent"],
+                "purchases": row["purchases"],
+                "revenue": str(row["revenue"]),
+                "commission": str(row["commission"]),
+            }
+            for row in rows
+        ],
+        "total": {
+            "purchases": sum(row["purchases"] for row in rows),
+            "revenue": str(sum((row["revenue"] for row in rows), Decimal("0.00"))),
+            "commission": str(sum((row["commission"] for row in rows), Decimal("0.00"))),
+        },
+    })
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
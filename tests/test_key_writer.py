@@ -0,0 +1,127 @@
+# Очередь отложенной записи KeyWriter без БД: get_conn подменяется заглушкой.
+#
+#   python -m unittest discover tests
+import contextlib
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import server
+
+
+class FakeDB:
+    def __init__(self, hwids=None):
+        self.hwids = dict(hwids or {})
+        self.touches = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connect(self):
+        yield FakeConn(self)
+
+    def touched(self):
+        with self.lock:
+            return {key: version for batch in self.touches for key, version in batch.items()}
+
+
+class FakeConn:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def execute(self, sql, params):
+        with self.db.lock:
+            if sql is server.KEYS_TOUCH_SQL:
+                keys, _, versions, _ = params
+                self.db.touches.append(dict(zip(keys, versions)))
+            elif sql is server.KEYS_BIND_SQL:
+                self.rows = []
+                for key, hwid in zip(*params):
+                    if key in self.db.hwids and not self.db.hwids[key]:
+                        self.db.hwids[key] = hwid
+                        self.rows.append({"key": key, "hwid": hwid})
+            elif sql is server.KEYS_HWID_SQL:
+                self.rows = [{"key": key, "hwid": self.db.hwids[key]} for key in params[0] if key in self.db.hwids]
+        return self
+
+    def cursor(self):
+        return contextlib.nullcontext(self)
+
+    def fetchall(self):
+        return self.rows
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class KeyWriterTest(unittest.TestCase):
+    def make_writer(self, hwids=None, batch_size=500, interval=0.2):
+        self.db = FakeDB(hwids)
+        patcher = mock.patch.object(server, "get_conn", self.db.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        writer = server.KeyWriter(batch_size, interval, 0.005)
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_touch_after_idle_is_flushed_by_interval(self):
+        writer = self.make_writer(interval=0.2)
+        writer.touch("A", "1", datetime.now())
+        self.assertTrue(wait_for(lambda: "A" in self.db.touched()))
+        time.sleep(0.3)
+        writer.touch("B", "1", datetime.now())
+        self.assertTrue(wait_for(lambda: "B" in self.db.touched(), timeout=1))
+        self.assertEqual(writer.stats()["queued_touches"], 0)
+
+    def test_touches_of_one_key_collapse(self):
+        writer = self.make_writer(interval=60)
+        writer.touch("A", "1", datetime.now())
+        writer.touch("A", "2", datetime.now())
+        writer.stop()
+        self.assertEqual(self.db.touches, [{"A": "2"}])
+
+    def test_full_batch_is_flushed_without_waiting(self):
+        writer = self.make_writer(batch_size=3, interval=60)
+        for key in ("A", "B", "C"):
+            writer.touch(key, "1", datetime.now())
+        self.assertTrue(wait_for(lambda: len(self.db.touched()) == 3, timeout=1))
+
+    def test_stop_flushes_queue(self):
+        writer = self.make_writer(interval=60)
+        writer.touch("A", "1", datetime.now())
+        writer.stop()
+        self.assertEqual(self.db.touched(), {"A": "1"})
+
+    def test_concurrent_binds_save_one_hwid(self):
+        writer = self.make_writer({"K": ""})
+        results = []
+        threads = [
+            threading.Thread(target=lambda hwid=f"H{i}": results.append(writer.bind({"K": hwid})["K"]))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 20)
+        self.assertEqual(set(results), {self.db.hwids["K"]})
+
+    def test_bind_of_deleted_key_returns_none(self):
+        writer = self.make_writer({"K": ""})
+        self.assertEqual(writer.bind({"K": "H", "GONE": "H"}), {"K": "H", "GONE": None})
+
+    def test_bind_of_null_hwid_key(self):
+        writer = self.make_writer({"K": None})
+        self.assertEqual(writer.bind({"K": "H"}), {"K": "H"})
+
+
+if __name__ == "__main__":
+    unittest.main()
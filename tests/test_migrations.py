@@ -0,0 +1,16 @@
+# Порядок списка MIGRATIONS: migrate() применяет недостающие версии в порядке списка.
+#
+#   python -m unittest discover tests
+import unittest
+
+import server
+
+
+class MigrationsOrderTest(unittest.TestCase):
+    def test_versions_increase(self):
+        versions = [m["version"] for m in server.MIGRATIONS]
+        self.assertEqual(versions, sorted(set(versions)))
+
+
+if __name__ == "__main__":
+    unittest.main()